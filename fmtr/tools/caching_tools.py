@@ -1,6 +1,17 @@
+import asyncio
+import atexit
 import cachetools
+import functools
+import inspect
+import threading
+import time
+from collections.abc import MutableMapping
+from concurrent.futures import Future
+from contextlib import nullcontext
+from dataclasses import dataclass
 from datetime import timedelta, datetime
 from diskcache import Cache
+from typing import Any, Callable, Dict, Optional, Set, Tuple, List, Iterator
 
 from fmtr.tools.constants import Constants
 from fmtr.tools.logging_tools import logger
@@ -130,9 +141,11 @@ class TLRU(cachetools.TLRUCache):
     def get_ttu(self, _key, value, now) -> float | timedelta:
         """
 
-        Default implementation just adds on the static TTU
+        Default implementation just adds on the static TTU. Without one, items never expire.
 
         """
+        if self.ttu_static is None:
+            return datetime.max
         return now + self.ttu_static
 
     def expire(self, time=None):
@@ -181,6 +194,564 @@ class TLRU(cachetools.TLRUCache):
 
 
 
+class Shard(TLRU):
+    """
+
+    TLRU shard of a ConcurrentTLRU, with its own lock. Expired and evicted items are collected rather than logged, so they can be logged once the lock is released.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+        self.removed: List[Tuple[Any, Any]] = []
+
+    def expire(self, time=None):
+        items = cachetools.TLRUCache.expire(self, time)
+        self.removed.extend(items)
+        return items
+
+    def popitem(self):
+        key, value = cachetools.TLRUCache.popitem(self)
+        self.removed.append((key, value))
+        return key, value
+
+    def drain(self) -> List[Tuple[Any, Any]]:
+        removed, self.removed = self.removed, []
+        return removed
+
+
+class ConcurrentTLRU(MutableMapping):
+    """
+
+    Thread-safe TLRU, striped across shards by key hash, each with its own lock, so threads only contend when their keys share a shard.
+    LRU order, capacity (`maxsize` split evenly) and expiry are per shard. Logging happens outside the locks.
+
+    """
+    SHARDS = 16
+
+    def __init__(self, maxsize=1_024, timer=datetime.now, getsizeof=None, ttu_static=None, desc=None, shards=SHARDS):
+        size = -(-maxsize // shards)
+        self.shards = [Shard(maxsize=size, timer=timer, getsizeof=getsizeof, ttu_static=ttu_static, desc=desc) for _ in range(shards)]
+        self.desc = desc
+
+    @property
+    def cache_desc(self):
+        return self.desc or self.__class__.__name__
+
+    @property
+    def maxsize(self):
+        return sum(shard.maxsize for shard in self.shards)
+
+    @property
+    def currsize(self):
+        return sum(shard.currsize for shard in self.shards)
+
+    def get_shard(self, key) -> Shard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def log(self, removed: List[Tuple[Any, Any]]):
+        """
+
+        Log items expired or evicted during an operation.
+
+        """
+        for key, value in removed:
+            logger.debug(f'{self.cache_desc} cache removal: {TLRU.MASK_MAPPING.format(key=key, value=value)}')
+
+    def __getitem__(self, key):
+        shard = self.get_shard(key)
+        with shard.lock:
+            return shard[key]
+
+    def __setitem__(self, key, value):
+        shard = self.get_shard(key)
+        with shard.lock:
+            shard[key] = value
+            removed = shard.drain()
+        self.log(removed)
+
+    def __delitem__(self, key):
+        shard = self.get_shard(key)
+        with shard.lock:
+            del shard[key]
+
+    def __contains__(self, key):
+        shard = self.get_shard(key)
+        with shard.lock:
+            return key in shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self) -> Iterator:
+        """
+
+        Iterate over a snapshot of the keys, so other threads can carry on mutating.
+
+        """
+        for shard in self.shards:
+            with shard.lock:
+                keys = list(shard)
+            yield from keys
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        """
+
+        Snapshot of the items, taken shard by shard under their locks, as the mixin version (keys, then lookups) fails if anything expires in between.
+
+        """
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                items += shard.items()
+        return items
+
+    def values(self) -> List[Any]:
+        return [value for key, value in self.items()]
+
+    def get(self, key, default=None):
+        shard = self.get_shard(key)
+        with shard.lock:
+            return shard.get(key, default)
+
+    def pop(self, key, *default):
+        shard = self.get_shard(key)
+        with shard.lock:
+            return shard.pop(key, *default)
+
+    def get_or_set(self, key, factory: Callable[[], Any]):
+        """
+
+        Atomically get the value for a key, or compute it with `factory`, store and return it. The factory runs under the shard's lock, so at most once per key at a time, but it blocks other keys in the shard meanwhile.
+
+        """
+        shard = self.get_shard(key)
+        with shard.lock:
+            try:
+                return shard[key]
+            except KeyError:
+                pass
+            value = factory()
+            shard[key] = value
+            removed = shard.drain()
+        self.log(removed)
+        return value
+
+    def setdefault(self, key, default=None):
+        return self.get_or_set(key, lambda: default)
+
+    def expire(self, time=None) -> List[Tuple[Any, Any]]:
+        items = []
+        for shard in self.shards:
+            with shard.lock:
+                shard.expire(time)
+                items += shard.drain()
+        self.log(items)
+        return items
+
+    def clear(self):
+        for shard in self.shards:
+            with shard.lock:
+                shard.clear()
+                shard.drain()
+
+    def dump(self):
+        """
+
+        Dump contents
+
+        """
+        data = Dump(self.items())
+        return data
+
+    @property
+    def data(self):
+        """
+
+        Dump as property
+
+        """
+        return self.dump()
+
+
+class Tiered(MutableMapping):
+    """
+
+    Two-tier cache: a TLRU in front, for hot keys, over a Disk behind, for capacity. Reads fall through to disk and promote what they find.
+    Writes go to memory immediately, and are flushed to disk in the background, in batches (of up to `batch`, or every `interval`), each in a single transaction.
+    Until a batch commits, readers still see it, so they never promote the older values on disk over it.
+
+    """
+    DELETED = object()
+    MISSING = object()
+
+    def __init__(self, memory: TLRU | ConcurrentTLRU, disk: Disk, batch=256, interval=timedelta(seconds=1)):
+        self.memory = memory
+        self.disk = disk
+        self.batch = batch
+        self.interval = interval
+        self.pending: Dict[Any, Any] = {}
+        self.flushing: Dict[Any, Any] = {}
+        self.lock = threading.RLock()
+        self.lock_flush = threading.Lock()
+        self.lock_memory = nullcontext() if isinstance(memory, ConcurrentTLRU) else self.lock  # Plain TLRUs need guarding, even for reads
+        self.event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.is_closed = False
+
+    def start(self):
+        """
+
+        Start the background flusher, if not already running, making sure anything pending is flushed on exit.
+
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name=f'{self.__class__.__name__}-flusher', daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while not self.is_closed:
+            self.event.wait(self.interval.total_seconds())
+            self.event.clear()
+            self.flush()
+
+    def flush(self):
+        """
+
+        Write pending changes to disk, in one transaction. On failure, they're re-queued (unless since superseded) for the next flush.
+
+        """
+        with self.lock_flush:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.flushing = pending
+            if not pending:
+                return
+
+            try:
+                with self.disk.transact():
+                    for key, value in pending.items():
+                        if value is self.DELETED:
+                            self.disk.delete(key)
+                        else:
+                            self.disk[key] = value
+            except Exception as exception:
+                logger.exception(exception)
+                with self.lock:
+                    for key, value in pending.items():
+                        self.pending.setdefault(key, value)
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def close(self):
+        """
+
+        Stop the flusher, and flush anything still pending.
+
+        """
+        self.is_closed = True
+        self.event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+    def __getitem__(self, key):
+        with self.lock_memory:
+            value = self.memory.get(key, self.MISSING)
+        if value is not self.MISSING:
+            return value
+
+        value = self.get_unflushed(key)  # Evicted from memory before being flushed
+        if value is self.DELETED:
+            raise KeyError(key)
+        if value is not self.MISSING:
+            return value
+
+        value = self.disk[key]
+        with self.lock:
+            if self.get_unflushed(key) is self.MISSING and key not in self.memory:  # Unless written meanwhile
+                self.memory[key] = value
+        return value
+
+    def get_unflushed(self, key):
+        """
+
+        Value written, or deleted, but not yet committed to disk, if any.
+
+        """
+        with self.lock:
+            value = self.pending.get(key, self.MISSING)
+            if value is self.MISSING:
+                value = self.flushing.get(key, self.MISSING)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+            self.pending[key] = value
+            is_due = len(self.pending) >= self.batch
+        if self.thread is None:
+            self.start()
+        if is_due:
+            self.event.set()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        with self.lock:
+            self.memory.pop(key, None)
+            self.pending[key] = self.DELETED
+        if self.thread is None:
+            self.start()
+
+    def __contains__(self, key):
+        with self.lock_memory:
+            if key in self.memory:
+                return True
+        value = self.get_unflushed(key)
+        if value is not self.MISSING:
+            return value is not self.DELETED
+        return key in self.disk
+
+    def __iter__(self) -> Iterator:
+        """
+
+        Iterate over keys on disk, after flushing anything pending.
+
+        """
+        self.flush()
+        return iter(self.disk)
+
+    def __len__(self):
+        self.flush()
+        return len(self.disk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@dataclass
+class Memo:
+    """
+
+    Memoised value, with the (wall-clock) time it was computed, so freshness holds across processes sharing a Disk cache.
+
+    """
+    value: Any
+    stored: float
+
+
+class Memoizer:
+    """
+
+    Cache-backed memoisation of a sync or async function. Concurrent calls for the same key share one computation, and values past their TTL can still be served, for up to `stale`, while they are recomputed in the background.
+
+    """
+
+    def __init__(self, func: Callable, cache: Optional[TLRU | Disk] = None, ttl: Optional[timedelta] = None, stale: Optional[timedelta] = None, key: Callable = cachetools.keys.hashkey):
+        self.func = func
+        self.ttl = ttl
+        self.stale = stale
+        self.key = key
+        self.name = f'{func.__module__}.{func.__qualname__}'
+        self.cache = TLRU(ttu_static=self.lifetime, desc=self.name) if cache is None else cache
+        self.inflight: Dict[Tuple, Future | asyncio.Task] = {}
+        self.tasks: Set[asyncio.Task] = set()
+        self.lock = threading.RLock()
+
+    @property
+    def is_blocking(self) -> bool:
+        """
+
+        Whether cache access means disk I/O, so should be kept off the event loop.
+
+        """
+        return isinstance(self.cache, Disk)
+
+    @property
+    def lifetime(self) -> Optional[timedelta]:
+        """
+
+        How long values are kept, fresh or stale.
+
+        """
+        if self.ttl is None:
+            return None
+        return self.ttl + (self.stale or timedelta())
+
+    def get_key(self, args, kwargs) -> Tuple:
+        """
+
+        Key from the function name and arguments, as a plain tuple, so it also pickles consistently for Disk caches.
+
+        """
+        return self.name, *self.key(*args, **kwargs)
+
+    def lookup(self, key) -> Tuple[Optional[Memo], bool]:
+        """
+
+        Get any usable memo, and whether it is stale, so due recomputing.
+
+        """
+        with self.lock:
+            memo = self.cache.get(key)
+        if memo is None or self.ttl is None:
+            return memo, False
+
+        age = time.time() - memo.stored
+        if age < self.ttl.total_seconds():
+            return memo, False
+        if self.stale is not None and age < self.lifetime.total_seconds():
+            return memo, True
+        return None, False
+
+    def store(self, key, value):
+        memo = Memo(value=value, stored=time.time())
+        with self.lock:
+            if isinstance(self.cache, Disk) and self.lifetime is not None:
+                self.cache.set(key, memo, expire=self.lifetime.total_seconds())
+            else:
+                self.cache[key] = memo
+
+    def compute(self, key, future: Future, args, kwargs):
+        """
+
+        Compute and store a value, resolving the in-flight future with it (or its exception).
+
+        """
+        try:
+            value = self.func(*args, **kwargs)
+            self.store(key, value)
+        except BaseException as exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(value)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def refresh(self, key, future: Future, args, kwargs):
+        """
+
+        Recompute a stale value, in a background thread, logging any failure.
+
+        """
+        self.compute(key, future, args, kwargs)
+        if exception := future.exception():
+            logger.exception(exception)
+
+    def call(self, *args, **kwargs):
+        """
+
+        Memoised call of a sync function.
+
+        """
+        key = self.get_key(args, kwargs)
+        memo, is_stale = self.lookup(key)
+
+        with self.lock:
+            if memo is not None:
+                if is_stale and key not in self.inflight:
+                    future = self.inflight[key] = Future()
+                    threading.Thread(target=self.refresh, args=(key, future, args, kwargs), daemon=True).start()
+                return memo.value
+
+            future = self.inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self.inflight[key] = Future()
+
+        if is_owner:
+            self.compute(key, future, args, kwargs)
+        return future.result()
+
+    async def compute_async(self, key, args, kwargs):
+        try:
+            value = await self.func(*args, **kwargs)
+            if self.is_blocking:
+                await asyncio.to_thread(self.store, key, value)
+            else:
+                self.store(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def on_refreshed(self, task: asyncio.Task):
+        """
+
+        Log any failure of a background recomputation.
+
+        """
+        self.tasks.discard(task)
+        if not task.cancelled() and (exception := task.exception()):
+            logger.exception(exception)
+
+    async def call_async(self, *args, **kwargs):
+        """
+
+        Memoised call of an async function. Waiters are shielded, so one cancelled caller does not cancel the computation for the rest.
+        Disk lookups and stores run in a thread.
+
+        """
+        key = self.get_key(args, kwargs)
+        if self.is_blocking:
+            memo, is_stale = await asyncio.to_thread(self.lookup, key)
+        else:
+            memo, is_stale = self.lookup(key)
+
+        if memo is not None:
+            if is_stale and key not in self.inflight:
+                task = self.inflight[key] = asyncio.create_task(self.compute_async(key, args, kwargs))
+                self.tasks.add(task)
+                task.add_done_callback(self.on_refreshed)
+            return memo.value
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.inflight[key] = asyncio.create_task(self.compute_async(key, args, kwargs))
+        return await asyncio.shield(task)
+
+
+def memoize(func: Optional[Callable] = None, *, cache: Optional[TLRU | Disk] = None, ttl: Optional[timedelta] = None, stale: Optional[timedelta] = None, key: Callable = cachetools.keys.hashkey):
+    """
+
+    Decorator to memoise a sync or async function (or method) in a TLRU (by default) or Disk cache, keyed on its arguments. Usable bare, or with arguments.
+    Values are fresh for `ttl` (or, if none, until evicted), then served stale for up to `stale` while recomputed in the background.
+    Methods are keyed on `self` too, like any argument, so the cache keeps each instance alive until its entries are evicted (and Disk caches need it picklable).
+    To share entries between instances instead, pass a `key` that leaves it out, e.g. `cachetools.keys.methodkey`.
+
+    """
+
+    def decorator(func: Callable) -> Callable:
+        memoizer = Memoizer(func, cache=cache, ttl=ttl, stale=stale, key=key)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await memoizer.call_async(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return memoizer.call(*args, **kwargs)
+
+        wrapper.memoizer = memoizer
+        wrapper.cache = memoizer.cache
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
 if __name__ == '__main__':
     sec10 = timedelta(seconds=10)
     c = TLRU(ttu_static=sec10, maxsize=2, desc='Test Data')
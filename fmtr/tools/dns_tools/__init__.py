@@ -1,7 +1,7 @@
 from fmtr.tools.import_tools import MissingExtraMockModule
 
 try:
-    from fmtr.tools.dns_tools import server, client, dm, proxy
+    from fmtr.tools.dns_tools import server, client, dm, proxy, cache
     import dns
 except ModuleNotFoundError as exception:
-    dns = server = client = dm = proxy = MissingExtraMockModule('dns', exception)
+    dns = server = client = dm = proxy = cache = MissingExtraMockModule('dns', exception)
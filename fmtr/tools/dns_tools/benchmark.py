@@ -0,0 +1,328 @@
+"""
+
+Load-generation and latency benchmark for the DNS proxy, against a local stand-in upstream.
+
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+from fmtr.tools.dns_tools import client
+from fmtr.tools.dns_tools.proxy import Proxy
+from fmtr.tools.logging_tools import logger
+
+HOST = '127.0.0.1'
+ADDRESS_STUB = '192.0.2.1'
+TTL_STUB = 60 * 60
+TIMEOUT = 2
+
+
+class Workloads:
+    """
+
+    Benchmark workloads.
+
+    """
+    HIT = 'hit'  # Uniform over a warmed set of names
+    MISS = 'miss'  # Unique names, so every query goes upstream
+    MIXED = 'mixed'  # Zipf-distributed over a set of names, starting cold
+
+
+class Stub(asyncio.DatagramProtocol):
+    """
+
+    Stand-in upstream, answering every query after a fixed latency, and counting queries in a shared counter.
+
+    """
+
+    def __init__(self, latency: float, counter):
+        self.latency = latency
+        self.counter = counter
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        if question.rdtype == dns.rdatatype.A:
+            response.answer.append(dns.rrset.from_text(question.name, TTL_STUB, 'IN', 'A', ADDRESS_STUB))
+
+        asyncio.get_running_loop().call_later(self.latency, self.transport.sendto, response.to_wire(), addr)
+
+
+def run_stub(port: int, latency: float, counter):
+    """
+
+    Run the stand-in upstream (in its own process).
+
+    """
+
+    async def serve():
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: Stub(latency, counter), local_addr=(HOST, port))
+        await asyncio.Future()
+
+    asyncio.run(serve())
+
+
+def run_proxy(port: int, port_upstream: int, **kwargs):
+    """
+
+    Run a proxy in front of the stand-in upstream (in its own process).
+
+    """
+    proxy = Proxy(host=HOST, port=port, client=client.Plain(HOST, port_upstream), **kwargs)
+    asyncio.run(proxy.start())
+
+
+def get_cpu(pid: int) -> Optional[float]:
+    """
+
+    Get total CPU seconds used by a process, where /proc is available.
+
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    utime, stime = int(fields[11]), int(fields[12])
+    return (utime + stime) / os.sysconf('SC_CLK_TCK')
+
+
+class Generator(asyncio.DatagramProtocol):
+    """
+
+    Load generator. Keeps up to `concurrency` queries outstanding on a single socket, matching responses by message ID.
+
+    """
+
+    def __init__(self):
+        self.pending: Dict[int, tuple] = {}
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        id = int.from_bytes(data[:2], 'big')
+        if pending := self.pending.pop(id, None):
+            start, future = pending
+            if not future.done():
+                future.set_result(time.perf_counter() - start)
+
+    async def run(self, names: List[str], concurrency: int) -> 'Result':
+        """
+
+        Send a query for each name, returning latencies and timeouts.
+
+        """
+        loop = asyncio.get_running_loop()
+        queries = iter([dns.message.make_query(name, dns.rdatatype.A).to_wire() for name in names])
+        ids = iter(range(len(names)))
+        result = Result()
+
+        async def work():
+            for query in queries:
+                id = next(ids) % 0x10000
+                future = loop.create_future()
+                self.pending[id] = time.perf_counter(), future
+                self.transport.sendto(id.to_bytes(2, 'big') + query[2:])
+                try:
+                    result.latencies.append(await asyncio.wait_for(future, TIMEOUT))
+                except asyncio.TimeoutError:
+                    self.pending.pop(id, None)
+                    result.timeouts += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[work() for _ in range(concurrency)])
+        result.duration = time.perf_counter() - start
+
+        return result
+
+
+@dataclass
+class Result:
+    """
+
+    Measurements from a benchmark run.
+
+    """
+    latencies: List[float] = field(default_factory=list)
+    timeouts: int = 0
+    duration: float = 0
+    upstream: int = 0
+    cpu: Optional[float] = None
+
+    @property
+    def count(self) -> int:
+        return len(self.latencies) + self.timeouts
+
+    @property
+    def qps(self) -> float:
+        return len(self.latencies) / self.duration
+
+    def get_percentile(self, percentile: float) -> float:
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    @property
+    def hit_rate(self) -> float:
+        return max(0, 1 - self.upstream / self.count)
+
+    @property
+    def cpu_per_query(self) -> Optional[float]:
+        if self.cpu is None:
+            return None
+        return self.cpu / self.count
+
+    def __str__(self):
+        cpu = 'n/a' if self.cpu_per_query is None else f'{self.cpu_per_query * 1e6:.0f}us'
+        return (
+            f'{self.count} queries, {self.timeouts} timeouts, {self.qps:.0f} QPS, '
+            f'p50={self.get_percentile(50) * 1e3:.2f}ms p95={self.get_percentile(95) * 1e3:.2f}ms p99={self.get_percentile(99) * 1e3:.2f}ms, '
+            f'hit rate={self.hit_rate:.1%}, CPU/query={cpu}'
+        )
+
+
+def get_pool(names: int) -> List[str]:
+    return [f'name-{index}.bench.' for index in range(names)]
+
+
+def get_names(workload: str, count: int, names: int, zipf: float) -> List[str]:
+    """
+
+    Query names for a workload.
+
+    """
+    if workload == Workloads.MISS:
+        run = uuid.uuid4().hex[:8]
+        return [f'miss-{run}-{index}.bench.' for index in range(count)]
+
+    pool = get_pool(names)
+    if workload == Workloads.HIT:
+        return random.choices(pool, k=count)
+
+    weights = [1 / (rank ** zipf) for rank in range(1, names + 1)]
+    return random.choices(pool, weights=weights, k=count)
+
+
+async def measure(workload: str, port: int, counter, pid: int, count: int, concurrency: int, names: int, zipf: float) -> Result:
+    """
+
+    Run one workload against a running proxy.
+
+    """
+    loop = asyncio.get_running_loop()
+    transport, generator = await loop.create_datagram_endpoint(Generator, remote_addr=(HOST, port))
+
+    try:
+        if workload == Workloads.HIT:
+            await generator.run(get_pool(names), concurrency)
+
+        upstream, cpu = counter.value, get_cpu(pid)
+        result = await generator.run(get_names(workload, count, names, zipf), concurrency)
+        result.upstream = counter.value - upstream
+        if cpu is not None:
+            result.cpu = get_cpu(pid) - cpu
+    finally:
+        transport.close()
+
+    return result
+
+
+async def wait_ready(port: int):
+    """
+
+    Wait until the proxy answers.
+
+    """
+    loop = asyncio.get_running_loop()
+    transport, generator = await loop.create_datagram_endpoint(Generator, remote_addr=(HOST, port))
+    try:
+        for _ in range(50):
+            generator.pending.clear()
+            result = await generator.run(['ready.bench.'], 1)
+            if result.latencies:
+                return
+    finally:
+        transport.close()
+    raise TimeoutError(f'Proxy on port {port} did not become ready.')
+
+
+def run(workloads: List[str], latency: float = 0.02, count: int = 10_000, concurrency: int = 64, names: int = 1_000, zipf: float = 1.0, port: int = 5353, port_upstream: int = 5354, **kwargs) -> Dict[str, Result]:
+    """
+
+    Run each workload against a fresh proxy (with any extra `kwargs`) in front of a stand-in upstream with the given latency (in seconds).
+
+    """
+    counter = multiprocessing.Value('q', 0)
+    stub = multiprocessing.Process(target=run_stub, args=(port_upstream, latency, counter), daemon=True)
+    stub.start()
+
+    results = {}
+    try:
+        for workload in workloads:
+            proxy = multiprocessing.Process(target=run_proxy, args=(port, port_upstream), kwargs=kwargs, daemon=True)
+            proxy.start()
+            try:
+                asyncio.run(wait_ready(port))
+                with logger.span(f'Benchmarking workload {workload=}...'):
+                    results[workload] = asyncio.run(measure(workload, port, counter, proxy.pid, count, concurrency, names, zipf))
+                logger.info(f'{workload}: {results[workload]}')
+            finally:
+                proxy.terminate()
+                proxy.join()
+    finally:
+        stub.terminate()
+        stub.join()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the DNS proxy against a local stand-in upstream')
+    parser.add_argument('--workloads', nargs='+', default=[Workloads.HIT, Workloads.MISS, Workloads.MIXED], choices=[Workloads.HIT, Workloads.MISS, Workloads.MIXED])
+    parser.add_argument('--latency', type=float, default=20, help='Upstream latency in milliseconds')
+    parser.add_argument('--queries', type=int, default=10_000, help='Queries per workload')
+    parser.add_argument('--concurrency', type=int, default=64, help='Outstanding queries')
+    parser.add_argument('--names', type=int, default=1_000, help='Distinct names for the hit and mixed workloads')
+    parser.add_argument('--zipf', type=float, default=1.0, help='Zipf exponent for the mixed workload')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--port-upstream', type=int, default=5354)
+
+    args = parser.parse_args()
+
+    results = run(
+        args.workloads,
+        latency=args.latency / 1e3,
+        count=args.queries,
+        concurrency=args.concurrency,
+        names=args.names,
+        zipf=args.zipf,
+        port=args.port,
+        port_upstream=args.port_upstream,
+    )
+
+    for workload, result in results.items():
+        print(f'{workload:>6}: {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import List, Optional, Iterator, Set, Self
+
+from fmtr.tools.logging_tools import logger
+from fmtr.tools.path_tools import Path
+
+NAMES_LOCAL = {'localhost', 'localhost.localdomain', 'local', 'broadcasthost', 'ip6-localhost', 'ip6-loopback', '0.0.0.0'}
+COMMENTS = ('#', '!', '[')
+
+
+def normalize(name: str) -> str:
+    return name.strip().rstrip('.').lower()
+
+
+def is_ip(token: str) -> bool:
+    return ':' in token or token.replace('.', '').isdigit()
+
+
+def iter_suffixes(name: str) -> Iterator[str]:
+    """
+
+    Yield the name and each of its parents, e.g. `a.b.com`, `b.com`, `com`.
+
+    """
+    yield name
+    index = name.find('.')
+    while index != -1:
+        yield name[index + 1:]
+        index = name.find('.', index + 1)
+
+
+def parse_line(line: str) -> Iterator[str]:
+    """
+
+    Parse domains from a blocklist line, in hosts (`0.0.0.0 a.com b.com`), adblock (`||a.com^`) or plain (`a.com`) format.
+    Adblock rules with options, wildcards or paths are not domain rules, so are skipped.
+
+    """
+    line = line.strip()
+    if not line or line.startswith(COMMENTS) or line.startswith('@@'):
+        return
+
+    if line.startswith('||'):
+        domain, sep, rest = line[2:].partition('^')
+        if rest or any(char in domain for char in '*/$'):
+            return
+        yield normalize(domain)
+        return
+
+    tokens = line.split('#', 1)[0].split()
+    if len(tokens) > 1 and is_ip(tokens[0]):
+        tokens = tokens[1:]  # hosts format
+
+    for token in tokens:
+        domain = normalize(token)
+        if domain and domain not in NAMES_LOCAL and '/' not in domain:
+            yield domain
+
+
+@dataclass
+class Source:
+    """
+
+    One blocklist, as a sorted array of 64-bit name hashes: compact (8 bytes per domain) with binary-search lookups.
+    Hashes are process-local (Python's own string hash), so sources are never persisted, only rebuilt.
+
+    """
+    name: str
+    hashes: array
+
+    @classmethod
+    def from_path(cls, path: Path) -> Self:
+        with path.open(encoding='utf-8', errors='ignore') as file:
+            hashes = {hash(domain) for line in file for domain in parse_line(line)}
+        return cls(name=path.stem, hashes=array('q', sorted(hashes)))
+
+    def __contains__(self, hash_name: int) -> bool:
+        index = bisect_left(self.hashes, hash_name)
+        return index < len(self.hashes) and self.hashes[index] == hash_name
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+@dataclass
+class Blocklist:
+    """
+
+    Domain blocklist engine. A name is blocked if it, or any parent domain, appears in any source list.
+    Reloads build new sources off the event loop, then swap them in atomically, so queries are never paused.
+
+    """
+    paths: List[Path]
+    allow: List[str] = field(default_factory=list)
+    sources: List[Source] = field(default_factory=list, init=False)
+
+    def __post_init__(self):
+        self.paths = [Path(path) for path in self.paths]
+
+    @cached_property
+    def allowed(self) -> Set[int]:
+        return {hash(normalize(name)) for name in self.allow}
+
+    def build(self) -> List[Source]:
+        sources = []
+        for path in self.paths:
+            with logger.span(f'Loading blocklist {str(path)=}...'):
+                source = Source.from_path(path)
+                logger.info(f'Loaded {len(source)} domains from blocklist {source.name}.')
+            sources.append(source)
+        return sources
+
+    def load(self):
+        """
+
+        Load synchronously.
+
+        """
+        self.sources = self.build()
+
+    async def reload(self):
+        """
+
+        Rebuild in a thread and swap in the result.
+
+        """
+        self.sources = await asyncio.to_thread(self.build)
+
+    def get_blocked_by(self, name: str) -> Optional[str]:
+        """
+
+        Get the name of the first list blocking the name (or any of its parents), if any. Allowed names (and their subdomains) are never blocked.
+
+        """
+        hashes = [hash(suffix) for suffix in iter_suffixes(normalize(name))]
+
+        if any(hash_name in self.allowed for hash_name in hashes):
+            return None
+
+        for source in self.sources:
+            for hash_name in hashes:
+                if hash_name in source:
+                    return source.name
+
+        return None
+
+    def __len__(self):
+        return sum(len(source) for source in self.sources)
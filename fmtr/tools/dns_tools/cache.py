@@ -0,0 +1,296 @@
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+from dns import rcode as dnspython_rcode, message as dnspython_message
+from typing import Optional, List, Tuple, Self, Dict
+
+from fmtr.tools import caching_tools as caching
+from fmtr.tools.dns_tools import wire as dns_wire
+from fmtr.tools.dns_tools.dm import Response, Request
+
+
+@dataclass
+class Entry:
+    """
+
+    Cached response, as wire bytes plus the metadata needed to serve it without parsing: record TTL offsets, the (monotonic) time it was stored and the TTL it was stored with.
+
+    """
+    TTL_STALE = 30  # TTL of stale answers, as recommended by RFC 8767
+    SIZE_OVERHEAD = 320  # Approximate bytes for the entry object, its key and cache bookkeeping
+    SIZE_TTL = 72  # Approximate bytes per TTL offset tuple
+
+    wire: bytes
+    ttls: List[Tuple[int, int]]
+    stored: float
+    ttl: int
+    blocked_by: Optional[str] = None
+    hits: int = 0
+    is_refreshing: bool = False
+
+    @classmethod
+    def from_response(cls, response: Response, stored: float, ttl_max: int) -> Self:
+        """
+
+        Initialise from a response, capturing any modifications made to its message.
+
+        """
+        wire = response.message.to_wire()
+        return cls(wire=wire, ttls=dns_wire.get_ttls(wire), stored=stored, ttl=min(response.ttl, ttl_max), blocked_by=response.blocked_by)
+
+    @property
+    def size(self) -> int:
+        """
+
+        Approximate memory footprint, in bytes.
+
+        """
+        return len(self.wire) + self.SIZE_OVERHEAD + self.SIZE_TTL * len(self.ttls)
+
+    @property
+    def rcode(self) -> int:
+        return dns_wire.HEADER.unpack_from(self.wire)[1] & dns_wire.MASK_RCODE
+
+    def get_age(self, now: float) -> int:
+        return int(now - self.stored)
+
+    def is_stale(self, now: float) -> bool:
+        return self.get_age(now) >= self.ttl
+
+    def get_wire(self, now: float, request: bytes) -> bytearray:
+        """
+
+        Copy of the response wire for the given request, with TTLs decremented by the time spent in cache (or pinned to the stale TTL if expired).
+
+        """
+        age = self.get_age(now)
+        ttl_override = self.TTL_STALE if age >= self.ttl else None
+        return dns_wire.patch(self.wire, request, self.ttls, age=age, ttl_override=ttl_override)
+
+    def get_response(self, now: float, request: bytes) -> Response:
+        """
+
+        As above, but as a Response object.
+
+        """
+        return Response(bytes(self.get_wire(now, request)), blocked_by=self.blocked_by)
+
+    def get_response_synthesized(self, now: float, request: Request) -> Response:
+        """
+
+        NXDOMAIN for a name at or below this (NXDOMAIN) entry's name, which cannot exist either (RFC 8020), carrying this entry's SOA with remaining TTLs.
+
+        """
+        age = self.get_age(now)
+        source = dnspython_message.from_wire(self.wire)
+        message = request.get_response_template()
+        message.set_rcode(dnspython_rcode.NXDOMAIN)
+        for rrset in source.authority:
+            rrset.ttl = max(rrset.ttl - age, 0)
+            message.authority.append(rrset)
+        return Response.from_message(message)
+
+    def __str__(self):
+        return f'{self.__class__.__name__}(size={len(self.wire)}, ttl={self.ttl}, hits={self.hits})'
+
+
+@dataclass
+class Stats:
+    """
+
+    Cache statistics.
+
+    """
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0
+        return self.hits / lookups
+
+
+class Cache(caching.TLRU):
+    """
+
+    DNS response cache, bounded by (approximate) memory in bytes rather than entry count, as response sizes vary widely. Entries hold only wire bytes and metadata.
+    Entries live for their own response TTL, plus an optional serve-stale window (RFC 8767), during which expired answers can still be served while they are refreshed.
+
+    """
+    NXDOMAINS = 16_384  # Names in the NXDOMAIN index
+
+    def __init__(self, maxsize=32 * 1024 * 1024, stale: Optional[timedelta] = None, ttl_max: int = 60 * 60 * 24, prefetch_hits: Optional[int] = None, prefetch_fraction: float = 0.9, desc='DNS Response'):
+        """
+
+        The `maxsize` is in bytes. Entries with at least `prefetch_hits` hits are due for refresh-ahead once `prefetch_fraction` of their TTL has elapsed.
+
+        """
+        super().__init__(maxsize=maxsize, timer=time.monotonic, getsizeof=self.get_size, desc=desc)
+        self.stale = stale
+        self.ttl_max = ttl_max
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_fraction = prefetch_fraction
+        self.nxdomains = caching.TLRU(maxsize=self.NXDOMAINS, timer=time.monotonic, ttu_static=ttl_max, desc='DNS NXDOMAIN')
+        self.stats = Stats()
+
+    @staticmethod
+    def get_size(entry: Entry) -> int:
+        return entry.size
+
+    def expire(self, time=None):
+        """
+
+        Count expiries.
+
+        """
+        items = super().expire(time)
+        self.stats.expirations += len(items)
+        return items
+
+    def popitem(self):
+        """
+
+        Count evictions.
+
+        """
+        item = super().popitem()
+        self.stats.evictions += 1
+        return item
+
+    def get_nxdomain(self, key, now: float) -> Optional[Entry]:
+        """
+
+        Find a fresh NXDOMAIN entry for the key's name, or any of its parents (for any type, but the same key flags), e.g. to absorb floods of random names under a non-existent domain.
+
+        """
+        flags = dns_wire.get_key_flags(key)
+        for name in dns_wire.iter_names(dns_wire.get_key_name(key)):
+            key_nxdomain = self.nxdomains.get(name + flags)
+            if key_nxdomain is None:
+                continue
+
+            entry = self.get(key_nxdomain)
+            if entry and entry.rcode == dnspython_rcode.NXDOMAIN and not entry.is_stale(now):
+                return entry
+
+        return None
+
+    @property
+    def stale_seconds(self) -> float:
+        if not self.stale:
+            return 0
+        return self.stale.total_seconds()
+
+    def get_ttu(self, _key, entry: Entry, now) -> float:
+        """
+
+        Expire once the response TTL and any serve-stale window have both elapsed.
+
+        """
+        return entry.stored + entry.ttl + self.stale_seconds
+
+    def is_refresh_due(self, entry: Entry, now: float) -> bool:
+        """
+
+        Whether an entry should be refreshed in the background: either it is stale, or it is popular and nearing expiry.
+
+        """
+        if entry.is_refreshing:
+            return False
+
+        if entry.is_stale(now):
+            return True
+
+        if self.prefetch_hits is None or entry.hits < self.prefetch_hits:
+            return False
+
+        return entry.get_age(now) >= entry.ttl * self.prefetch_fraction
+
+    @property
+    def offset(self) -> float:
+        """
+
+        Offset from the monotonic cache timer to wall-clock time.
+
+        """
+        return time.time() - self.timer()
+
+    def get_record(self, key, entry: Entry) -> Dict:
+        """
+
+        Entry as a plain record, with wall-clock timestamps, so it can be shared between processes or survive a restart.
+
+        """
+        offset = self.offset
+        return dict(wire=entry.wire, stored=entry.stored + offset, ttl=entry.ttl, blocked_by=entry.blocked_by, hits=entry.hits, expires=self.get_ttu(key, entry, None) + offset)
+
+    def load_record(self, key, record: Dict) -> Optional[Entry]:
+        """
+
+        Restore an entry from a record, unless it has since expired.
+
+        """
+        entry = Entry(
+            wire=record['wire'],
+            ttls=dns_wire.get_ttls(record['wire']),
+            stored=record['stored'] - self.offset,
+            ttl=record['ttl'],
+            blocked_by=record['blocked_by'],
+            hits=record['hits'],
+        )
+        self[key] = entry
+        return self.get(key)
+
+    def get_snapshot(self) -> Dict[bytes, Dict]:
+        """
+
+        Get all live entries as records.
+
+        """
+        self.expire()
+
+        records = {}
+        for key in list(self):
+            if entry := self.get(key):
+                records[key] = self.get_record(key, entry)
+
+        return records
+
+    def load_snapshot(self, records: Dict[bytes, Dict]) -> int:
+        """
+
+        Restore entries from records, skipping any that have since expired. Returns the number restored.
+
+        """
+        count = 0
+        for key, record in records.items():
+            count += self.load_record(key, record) is not None
+
+        return count
+
+    def store(self, key, response: Response) -> Optional[Entry]:
+        """
+
+        Cache a response, capturing any modifications made to its message. Failures never replace a usable (fresh or stale) entry.
+        Hit counts carry over (halved, so popularity decays) when an entry is refreshed. Upstream NXDOMAINs are also indexed by name, to answer for names beneath them.
+        Only those with no answers are, though: with a CNAME chain, the NXDOMAIN is for the chain's last target, not the name asked about (RFC 6604).
+
+        """
+        previous = self.get(key)
+        if response.rcode == dnspython_rcode.SERVFAIL and previous:
+            previous.is_refreshing = False
+            return None
+
+        entry = Entry.from_response(response, stored=self.timer(), ttl_max=self.ttl_max)
+        if previous:
+            entry.hits = previous.hits // 2
+
+        self[key] = entry
+        if entry.rcode == dnspython_rcode.NXDOMAIN and not entry.blocked_by and not response.message.answer:
+            self.nxdomains[dns_wire.get_key_name(key) + dns_wire.get_key_flags(key)] = key
+
+        return self.get(key)
@@ -1,12 +1,22 @@
-from dataclasses import dataclass
-from dns import query as dnspython_query, message as dnspython_message, rdatatype as dnspython_rdatatype, rcode as dnspython_rcode
+import asyncio
+import httpx
+import random
+import ssl
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from dns import asyncquery as dnspython_asyncquery, message as dnspython_message, rdatatype as dnspython_rdatatype, rcode as dnspython_rcode
+from dns.message import QueryMessage
 from functools import cached_property
 from httpx_retries import Retry, RetryTransport
-from typing import Optional
+from typing import Optional, List, Dict, Tuple, Set
 
 from fmtr.tools import http_tools as http
+from fmtr.tools.dns_tools import wire as dns_wire, sampling
 from fmtr.tools.dns_tools.dm import Exchange, Response
+from fmtr.tools.dns_tools.metrics import metrics, Names
 from fmtr.tools.logging_tools import logger
+from fmtr.tools.string_tools import join
 
 RETRY_STRATEGY = Retry(
     total=2,  # initial + 1 retry
@@ -29,69 +39,734 @@ class HTTPClientDoH(http.Client):
     TRANSPORT = RetryTransport(retry=RETRY_STRATEGY)
 
 
+class HTTPClientDoHAsync(http.AsyncClient):
+    """
+
+    Async HTTP client for DoH. Uses a single shared, keep-alive connection pool with HTTP/2, so many in-flight queries are multiplexed over few connections.
+    Fails fast rather than retrying: the DoH client fails over to another of the endpoint's addresses instead.
+
+    """
+    TIMEOUT = httpx.Timeout(5, connect=2)
+    LIMITS = httpx.Limits(
+        max_connections=16,  # each HTTP/2 connection multiplexes many concurrent streams
+        max_keepalive_connections=16,
+        keepalive_expiry=120,
+    )
+
+    @cached_property
+    def transport(self) -> httpx.AsyncHTTPTransport:
+        """
+
+        HTTP/2 pooled transport
+
+        """
+        return httpx.AsyncHTTPTransport(http2=True, limits=self.LIMITS)
+
+
+class Client:
+    """
+
+    Base upstream client. Subclasses implement `query`, raising on failure, and the exchange is resolved with its response, or SERVFAIL.
+
+    """
+
+    @property
+    def name(self) -> str:
+        return self.__class__.__name__
+
+    async def query(self, query: QueryMessage) -> Response:
+        """
+
+        To be defined in subclasses.
+
+        """
+        raise NotImplementedError
+
+    async def resolve(self, exchange: Exchange):
+        """
+
+        Resolve the exchange's latest question upstream, recording its latency and any error.
+
+        """
+        start = time.perf_counter()
+        try:
+            exchange.response = await self.query(exchange.query_last)
+        except Exception as exception:
+            metrics.increment(Names.UPSTREAM_ERRORS, upstream=self.name)
+            exchange.response.message.set_rcode(dnspython_rcode.SERVFAIL)
+            exchange.is_complete = True
+            logger.exception(exception)
+        finally:
+            metrics.observe(Names.UPSTREAM_SECONDS, time.perf_counter() - start, upstream=self.name)
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """
+
+    Long-lived upstream UDP socket, multiplexing outstanding queries by (random) message ID. Responses whose question does not match are ignored, as possible spoofs.
+
+    """
+
+    def __init__(self):
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.pending: Dict[int, Tuple[bytes, asyncio.Future]] = {}
+        self.is_closed = False
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < dns_wire.SIZE_HEADER:
+            return
+
+        id = int.from_bytes(data[:2], 'big')
+        pending = self.pending.get(id)
+        if not pending:
+            return
+
+        question, future = pending
+        try:
+            is_match = dns_wire.get_question(data) == question
+        except (ValueError, IndexError):
+            is_match = False
+
+        if is_match and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exception: OSError):
+        """
+
+        Socket errors (e.g. ICMP port unreachable) fail all pending queries immediately, rather than letting them time out. The socket is closed, so a fresh one replaces it.
+
+        """
+        self.close(ConnectionError(f'Upstream socket error: {exception!r}'))
+
+    def connection_lost(self, exception: Optional[Exception]):
+        self.close(exception or ConnectionError('Upstream socket closed'))
+
+    def close(self, exception: Exception):
+        self.is_closed = True
+        if self.transport is not None:
+            self.transport.close()
+        for question, future in self.pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    def get_id(self) -> int:
+        while True:
+            id = random.getrandbits(16)
+            if id not in self.pending:
+                return id
+
+    async def query(self, wire: bytes, timeout: float, retransmit: float) -> bytes:
+        """
+
+        Send a raw query under a fresh ID, retransmitting with exponential backoff until answered or timed out. Returns the raw response, still with that ID.
+
+        """
+        if self.is_closed:
+            raise ConnectionError('Upstream socket closed')
+
+        loop = asyncio.get_running_loop()
+        id = self.get_id()
+        wire = id.to_bytes(2, 'big') + wire[2:]
+        future = loop.create_future()
+        self.pending[id] = dns_wire.get_question(wire), future
+
+        deadline = loop.time() + timeout
+        interval = retransmit
+        try:
+            while True:
+                self.transport.sendto(wire)
+                remaining = deadline - loop.time()
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), min(interval, remaining))
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        raise TimeoutError(f'Upstream query timed out after {timeout}s')
+                    interval *= 2
+        finally:
+            del self.pending[id]
+            future.cancel()
+
+
 @dataclass
-class Plain:
+class Plain(Client):
     """
 
-    Plain DNS
+    Plain DNS, over a small pool of long-lived UDP sockets, falling back to TCP for truncated responses.
 
     """
+    TIMEOUT = 5
+    RETRANSMIT = 1
+    SOCKETS = 4
+
     host: str
     port: int = 53
     ttl_min: Optional[int] = None
+    sockets: List[UDPProtocol] = field(default_factory=list, init=False, repr=False, compare=False)
+    sockets_loop: Optional[asyncio.AbstractEventLoop] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def name(self) -> str:
+        return f'{self.host}:{self.port}'
+
+    async def get_socket(self) -> UDPProtocol:
+        """
+
+        Get a socket from the pool, opening up to `SOCKETS` on demand. Sockets belong to the loop they were opened on, so a new loop (e.g. in a forked worker) gets its own.
+
+        """
+        loop = asyncio.get_running_loop()
+        if self.sockets_loop is not loop:
+            self.sockets, self.sockets_loop = [], loop
+
+        self.sockets = [socket for socket in self.sockets if not socket.is_closed]
+        if len(self.sockets) >= self.SOCKETS:
+            return random.choice(self.sockets)
 
-    def resolve(self, exchange: Exchange):
+        transport, socket = await loop.create_datagram_endpoint(UDPProtocol, remote_addr=(self.host, self.port))
+        if len(self.sockets) >= self.SOCKETS:  # Filled while opening this one.
+            transport.close()
+            return random.choice(self.sockets)
 
-        with logger.span(f'UDP {self.host}:{self.port}'):
-            response_plain = dnspython_query.udp(q=exchange.query_last, where=self.host, port=self.port)
-            response = Response.from_message(response_plain)
-            for answer in response.message.answer:
-                answer.ttl = max(answer.ttl, self.ttl_min or answer.ttl)
+        self.sockets.append(socket)
+        return socket
 
-        exchange.response = response
+    async def query(self, query: QueryMessage) -> Response:
+        """
+
+        Query via plain UDP, without blocking the event loop, and retry over TCP if the response was truncated.
+
+        """
+
+        with sampling.span('UDP {host}:{port}', host=self.host, port=self.port):
+            socket = await self.get_socket()
+            wire = await socket.query(query.to_wire(), timeout=self.TIMEOUT, retransmit=self.RETRANSMIT)
+            wire = query.id.to_bytes(2, 'big') + wire[2:]
+
+        id, flags, *_ = dns_wire.HEADER.unpack_from(wire)
+        if flags & dns_wire.FLAG_TC:
+            with sampling.span('TCP {host}:{port} (truncated)', host=self.host, port=self.port):
+                response_plain = await dnspython_asyncquery.tcp(q=query, where=self.host, port=self.port, timeout=self.TIMEOUT)
+        else:
+            response_plain = dnspython_message.from_wire(wire)
+
+        for answer in response_plain.answer:
+            answer.ttl = max(answer.ttl, self.ttl_min or answer.ttl)
+        return Response.from_message(response_plain)
 
 
 @dataclass
-class HTTP:
+class HTTP(Client):
     """
 
-    DNS over HTTP
+    DNS over HTTP. The endpoint's full A/AAAA set is bootstrapped, and refreshed in the background as its TTL expires. Queries are spread across healthy addresses,
+    and fail over to another immediately if one errors. Failing addresses are ejected, then health-checked until they recover.
 
     """
 
     HEADERS = {"Content-Type": "application/dns-message"}
-    CLIENT = HTTPClientDoH()
+    CLIENT = HTTPClientDoHAsync()
     BOOTSTRAP = Plain('8.8.8.8')
+    TTL_MIN = 30
+    EJECT_DURATION = 30
+    ATTEMPTS = 3
 
     host: str
     url: str
+    ips: List[str] = field(default_factory=list, init=False)
+    expires: float = field(default=0, init=False)
+    ejected: Dict[str, float] = field(default_factory=dict, init=False)
+    tasks: Dict[str, asyncio.Task] = field(default_factory=dict, init=False, repr=False)
 
+    @property
+    def name(self) -> str:
+        return self.host
 
     @cached_property
-    def ip(self):
-        message = dnspython_message.make_query(self.host, dnspython_rdatatype.A, flags=0)
-        exchange = Exchange.from_wire(message.to_wire(), ip=None, port=None)
-        self.BOOTSTRAP.resolve(exchange)
-        ip = next(iter(exchange.response.answer.items.keys())).address
-        return ip
+    def lock(self) -> asyncio.Lock:
+        return asyncio.Lock()
+
+    async def bootstrap(self):
+        """
+
+        Resolve the endpoint's full A/AAAA set, to be refreshed once the shortest TTL has passed.
+
+        """
+        rdtypes = [dnspython_rdatatype.A, dnspython_rdatatype.AAAA]
+        queries = [self.BOOTSTRAP.query(dnspython_message.make_query(self.host, rdtype, flags=0)) for rdtype in rdtypes]
+        responses = await asyncio.gather(*queries, return_exceptions=True)
+
+        ips, ttls = [], []
+        for response in responses:
+            if isinstance(response, Exception):
+                logger.warning(f'Bootstrap query failed {self.host=}: {response!r}')
+                continue
+            for rrset in response.message.answer:
+                if rrset.rdtype in rdtypes:
+                    ips += [rdata.address for rdata in rrset]
+                    ttls.append(rrset.ttl)
+
+        if not ips:
+            raise UpstreamError(f'Could not bootstrap DoH host {self.host}')
+
+        self.ips = ips
+        self.expires = time.monotonic() + max(min(ttls), self.TTL_MIN)
+        self.ejected = {ip: until for ip, until in self.ejected.items() if ip in ips}
+        logger.info(f'Bootstrapped DoH host {self.host=} {self.ips=}')
+
+    async def refresh(self):
+        """
+
+        Re-bootstrap once, even when many queries find the addresses expired. On failure, keep any previous addresses for now.
+
+        """
+        async with self.lock:
+            if self.ips and time.monotonic() < self.expires:
+                return
+            try:
+                await self.bootstrap()
+            except Exception as exception:
+                if not self.ips:
+                    raise
+                logger.warning(f'Re-bootstrap failed. Keeping previous addresses {self.ips=}: {exception!r}')
+                self.expires = time.monotonic() + self.TTL_MIN
+
+    def create_task(self, name: str, coro):
+        """
+
+        Run a background task, unless one of the same name is already running.
 
-    def resolve(self, exchange: Exchange):
         """
+        task = self.tasks.get(name)
+        if task and not task.done():
+            coro.close()
+            return
+        self.tasks[name] = asyncio.get_running_loop().create_task(coro)
 
-        Resolve via DoH
+    async def get_ips(self) -> List[str]:
+        """
+
+        Get the endpoint addresses, bootstrapping on first use. Once expired, the current set is still used while it is refreshed in the background.
+
+        """
+        if not self.ips:
+            await self.refresh()
+        elif time.monotonic() >= self.expires:
+            self.create_task('refresh', self.refresh())
+        return self.ips
+
+    def get_ip(self, exclude: Set[str]) -> str:
+        """
+
+        Pick a random healthy address (spreading connections across them), not already tried. If none are healthy, pick the one ejected longest ago.
+
+        """
+        now = time.monotonic()
+        candidates = [ip for ip in self.ips if ip not in exclude] or self.ips
+        healthy = [ip for ip in candidates if self.ejected.get(ip, 0) <= now]
+        if healthy:
+            return random.choice(healthy)
+        return min(candidates, key=lambda ip: self.ejected[ip])
+
+    def eject(self, ip: str, exception: Exception):
+        """
+
+        Take a failing address out of rotation, and health-check it until it recovers.
 
         """
+        logger.warning(f'Ejecting DoH address {self.host=} {ip=}: {exception!r}')
+        self.ejected[ip] = time.monotonic() + self.EJECT_DURATION
+        self.create_task(ip, self.check(ip))
 
+    async def check(self, ip: str):
+        """
+
+        Probe an ejected address, readmitting it once it answers.
+
+        """
+        while ip in self.ejected and ip in self.ips:
+            await asyncio.sleep(self.EJECT_DURATION)
+            try:
+                await self.query_ip(ip, dnspython_message.make_query(self.host, dnspython_rdatatype.A))
+            except Exception as exception:
+                logger.warning(f'DoH address still failing {self.host=} {ip=}: {exception!r}')
+                self.ejected[ip] = time.monotonic() + self.EJECT_DURATION
+                continue
+
+            logger.info(f'DoH address recovered {self.host=} {ip=}')
+            self.ejected.pop(ip, None)
+
+    async def query_ip(self, ip: str, query: QueryMessage) -> Response:
+        """
+
+        Query via DoH, at a specific address.
+
+        """
         headers = self.HEADERS | dict(Host=self.host)
-        url = self.url.format(host=self.ip)
+        url = self.url.format(host=f'[{ip}]' if ':' in ip else ip)
+
+        response_doh = await self.CLIENT.post(url, headers=headers, content=query.to_wire())
+        response_doh.raise_for_status()
+        response = Response.from_http(response_doh)
+        return response
+
+    async def query(self, query: QueryMessage) -> Response:
+        """
+
+        Query via DoH, failing over to other addresses on connection errors or server errors.
+
+        """
+        await self.get_ips()
+
+        tried = set()
+        for attempt in range(self.ATTEMPTS):
+            ip = self.get_ip(tried)
+            tried.add(ip)
+            try:
+                return await self.query_ip(ip, query)
+            except (httpx.TransportError, httpx.HTTPStatusError) as exception:
+                if isinstance(exception, httpx.HTTPStatusError) and not exception.response.is_server_error:
+                    raise
+                self.eject(ip, exception)
+                if attempt == self.ATTEMPTS - 1:
+                    raise
+
+
+class TLSConnection:
+    """
+
+    Persistent upstream TLS connection, pipelining length-prefixed queries (RFC 7766) and matching possibly out-of-order responses by message ID.
+
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.pending: Dict[int, Tuple[bytes, asyncio.Future]] = {}
+        self.is_closed = False
+        self.task = asyncio.get_running_loop().create_task(self.read())
+
+    async def read(self):
+        """
+
+        Dispatch responses to their pending queries until the connection closes, then fail any still pending, so they can be retried.
 
+        """
         try:
-            response_doh = self.CLIENT.post(url, headers=headers, content=exchange.query_last.to_wire())
-            response_doh.raise_for_status()
-            response = Response.from_http(response_doh)
-            exchange.response = response
+            while True:
+                size = int.from_bytes(await self.reader.readexactly(2), 'big')
+                data = await self.reader.readexactly(size)
+                pending = self.pending.get(int.from_bytes(data[:2], 'big'))
+                if not pending:
+                    continue
+
+                question, future = pending
+                try:
+                    is_match = dns_wire.get_question(data) == question
+                except (ValueError, IndexError):
+                    continue  # Malformed frame. Leave the query pending, rather than dropping the connection.
 
+                if is_match and not future.done():
+                    future.set_result(data)
         except Exception as exception:
-            exchange.response.message.set_rcode(dnspython_rcode.SERVFAIL)
-            exchange.response.is_complete = True
-            logger.exception(exception)
+            self.close(ConnectionError(f'Upstream connection closed: {exception!r}'))
+
+    def close(self, exception: Exception):
+        self.is_closed = True
+        self.writer.close()
+        for question, future in self.pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+    def get_id(self) -> int:
+        while True:
+            id = random.getrandbits(16)
+            if id not in self.pending:
+                return id
+
+    async def query(self, wire: bytes, timeout: float) -> bytes:
+        """
+
+        Send a raw query under a fresh ID. Returns the raw response, still with that ID.
+
+        """
+        if self.is_closed:
+            raise ConnectionError('Upstream connection closed')
+
+        id = self.get_id()
+        wire = id.to_bytes(2, 'big') + wire[2:]
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id] = dns_wire.get_question(wire), future
+
+        try:
+            self.writer.write(len(wire).to_bytes(2, 'big') + wire)
+            await self.writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[id]
+
+
+@dataclass
+class TLS(Client):
+    """
+
+    DNS over TLS, over a few persistent connections, each pipelining many queries. Queries interrupted by a dropped connection are retried on a fresh one.
+
+    """
+    TIMEOUT = 5
+    CONNECTIONS = 2
+    PIPELINE = 128  # Outstanding queries per connection before opening another
+    ATTEMPTS = 3
+
+    host: str
+    port: int = 853
+    hostname: Optional[str] = None
+    ssl_context: Optional[ssl.SSLContext] = field(default=None, repr=False, compare=False)
+    connections: List[TLSConnection] = field(default_factory=list, init=False, repr=False, compare=False)
+    connections_loop: Optional[asyncio.AbstractEventLoop] = field(default=None, init=False, repr=False, compare=False)
+    lock: Optional[asyncio.Lock] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def name(self) -> str:
+        return f'{self.hostname or self.host}:{self.port}'
+
+    @cached_property
+    def context(self) -> ssl.SSLContext:
+        """
+
+        TLS context, verifying the upstream certificate against system CAs by default.
+
+        """
+        return self.ssl_context or ssl.create_default_context()
+
+    async def connect(self) -> TLSConnection:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.context, server_hostname=self.hostname or self.host),
+            self.TIMEOUT,
+        )
+        logger.info(f'Connected to DoT upstream {self.name}.')
+        return TLSConnection(reader, writer)
+
+    async def get_connection(self) -> TLSConnection:
+        """
+
+        Get the least-busy open connection, opening up to `CONNECTIONS` as needed. Connections belong to the loop they were opened on.
+
+        """
+        loop = asyncio.get_running_loop()
+        if self.connections_loop is not loop:
+            self.connections, self.connections_loop, self.lock = [], loop, asyncio.Lock()
+
+        if connection := self.get_connection_open():
+            return connection
+
+        async with self.lock:  # Only one connection opens at a time, so a burst of queries doesn't open one each.
+            if connection := self.get_connection_open():
+                return connection
+
+            connection = await self.connect()
+            self.connections.append(connection)
+            return connection
+
+    def get_connection_open(self) -> Optional[TLSConnection]:
+        """
+
+        Get the least-busy open connection, unless it's worth opening another.
+
+        """
+        self.connections = [connection for connection in self.connections if not connection.is_closed]
+        connection = min(self.connections, key=lambda connection: len(connection.pending), default=None)
+
+        if connection and (len(connection.pending) < self.PIPELINE or len(self.connections) >= self.CONNECTIONS):
+            return connection
+
+        return None
+
+    async def query(self, query: QueryMessage) -> Response:
+        """
+
+        Query via DoT, reconnecting transparently if the connection has dropped.
+
+        """
+        wire = query.to_wire()
+
+        with sampling.span('TLS {upstream}', upstream=self.name):
+            for attempt in range(self.ATTEMPTS):
+                connection = await self.get_connection()
+                try:
+                    wire_response = await connection.query(wire, self.TIMEOUT)
+                    break
+                except ConnectionError as exception:
+                    if attempt == self.ATTEMPTS - 1:
+                        raise
+                    logger.warning(f'Retrying on a new connection to {self.name}: {exception}')
+
+        return Response(query.id.to_bytes(2, 'big') + wire_response[2:])
+
+
+class UpstreamError(Exception):
+    """
+
+    Upstream answered, but with a failure code.
+
+    """
+
+
+@dataclass(eq=False)
+class Upstream:
+    """
+
+    Rolling latency and error-rate estimates for one upstream client. Upstreams with too many recent errors are ejected for a while.
+
+    """
+    WINDOW = 100
+    WINDOW_ERRORS = 20
+    SAMPLES_MIN = 5
+    ERROR_RATE_MAX = 0.5
+    EJECT_DURATION = 30
+    HEDGE_DELAY_DEFAULT = 0.2
+    HEDGE_DELAY_MIN = 0.01
+    EWMA_WEIGHT = 0.2
+
+    client: Client
+    latency: float = 0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=Upstream.WINDOW))
+    errors: deque = field(default_factory=lambda: deque(maxlen=Upstream.WINDOW_ERRORS))
+    ejected_until: float = 0
+
+    @property
+    def p95(self) -> float:
+        """
+
+        95th percentile latency, which is how long to wait before hedging.
+
+        """
+        if len(self.latencies) < self.SAMPLES_MIN:
+            return self.HEDGE_DELAY_DEFAULT
+        latencies = sorted(self.latencies)
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        return max(p95, self.HEDGE_DELAY_MIN)
+
+    @property
+    def error_rate(self) -> float:
+        if not self.errors:
+            return 0
+        return sum(self.errors) / len(self.errors)
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def record(self, now: float, latency: float, is_error: bool):
+        """
+
+        Update estimates with an outcome, ejecting if the error rate is too high.
+
+        """
+        self.errors.append(is_error)
+
+        if not is_error:
+            self.latencies.append(latency)
+            self.latency = latency if not self.latency else self.EWMA_WEIGHT * latency + (1 - self.EWMA_WEIGHT) * self.latency
+
+        if len(self.errors) >= self.SAMPLES_MIN and self.error_rate > self.ERROR_RATE_MAX:
+            logger.warning(f'Ejecting upstream {self.client.name} for {self.EJECT_DURATION}s {self.error_rate=:.0%}.')
+            self.ejected_until = now + self.EJECT_DURATION
+            self.errors.clear()
+
+
+@dataclass
+class Pool(Client):
+    """
+
+    Pool of upstream clients (of any type). Queries go to the fastest healthy upstream, and are hedged to the next-fastest if they take longer than the first's p95 latency.
+    Failures fail over to the next upstream immediately, and upstreams with high error rates are ejected for a while.
+
+    """
+    FAILURE_CODES = {dnspython_rcode.SERVFAIL, dnspython_rcode.REFUSED}
+
+    clients: List[Client]
+    hedge: bool = True
+
+    @cached_property
+    def upstreams(self) -> List[Upstream]:
+        return [Upstream(client) for client in self.clients]
+
+    @property
+    def name(self) -> str:
+        return join([client.name for client in self.clients], sep=', ')
+
+    @cached_property
+    def loop(self):
+        return asyncio.get_event_loop()
+
+    def rank(self) -> List[Upstream]:
+        """
+
+        Healthy upstreams, fastest first, then ejected ones as a last resort, soonest-returning first.
+
+        """
+        now = self.loop.time()
+        healthy = sorted([upstream for upstream in self.upstreams if upstream.is_healthy(now)], key=lambda upstream: upstream.latency)
+        ejected = sorted([upstream for upstream in self.upstreams if not upstream.is_healthy(now)], key=lambda upstream: upstream.ejected_until)
+        return healthy + ejected
+
+    async def query_upstream(self, upstream: Upstream, query: QueryMessage) -> Response:
+        """
+
+        Query a single upstream, recording the outcome. When a request loses a race, the time it had taken so far is recorded as a lower bound on its latency.
+
+        """
+        start = self.loop.time()
+        try:
+            response = await upstream.client.query(query)
+            if response.rcode in self.FAILURE_CODES:
+                raise UpstreamError(f'Upstream {upstream.client.name} returned {response.rcode_text}')
+        except asyncio.CancelledError:
+            upstream.record(self.loop.time(), self.loop.time() - start, is_error=False)
+            raise
+        except Exception:
+            upstream.record(self.loop.time(), self.loop.time() - start, is_error=True)
+            metrics.increment(Names.UPSTREAM_ERRORS, upstream=upstream.client.name)
+            raise
+
+        latency = self.loop.time() - start
+        upstream.record(self.loop.time(), latency, is_error=False)
+        metrics.observe(Names.UPSTREAM_SECONDS, latency, upstream=upstream.client.name)
+        return response
+
+    async def query(self, query: QueryMessage) -> Response:
+        """
+
+        Race upstreams: start with the best, hedge once on slowness and fail over on errors, returning the first successful response.
+
+        """
+        candidates = iter(self.rank())
+        upstream = next(candidates)
+        pending = {self.loop.create_task(self.query_upstream(upstream, query))}
+        is_hedged = not self.hedge
+        exception = None
+
+        try:
+            while pending:
+                timeout = None if is_hedged else upstream.p95
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if not task.exception():
+                        return task.result()
+                    exception = task.exception()
+
+                if not done:
+                    is_hedged = True
+
+                if upstream := next(candidates, None):
+                    if not done:
+                        sampling.info('Hedging request to upstream {upstream}...', upstream=upstream.client.name)
+                    pending.add(self.loop.create_task(self.query_upstream(upstream, query)))
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise exception
@@ -1,19 +1,21 @@
+import asyncio
 import dns
 import httpx
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 from dns import rcode as dnspython_rcode, reversename as dnspython_reversename
 from dns.message import Message, QueryMessage
 from dns.rrset import RRset
 from functools import cached_property
-from typing import Self, Optional, List
+from typing import Self, Optional, List, Tuple
 
+from fmtr.tools.dns_tools import wire as dns_wire
 from fmtr.tools.string_tools import join
 
 TTL_CODE_DEFAULTS = {
     dnspython_rcode.NOERROR: 300,  # Successful query
     dnspython_rcode.FORMERR: 60,  # Format error
     dnspython_rcode.SERVFAIL: 10,  # Server failure
-    dnspython_rcode.NXDOMAIN: 60 * 60,  # Non-existent domain
+    dnspython_rcode.NXDOMAIN: 60 * 5,  # Non-existent domain, without an SOA to take the negative TTL from
     dnspython_rcode.NOTIMP: 60,  # Not implemented
     dnspython_rcode.REFUSED: 60,  # Refused
     dnspython_rcode.YXDOMAIN: 600,  # Name exists when it should not
@@ -23,6 +25,40 @@ TTL_CODE_DEFAULTS = {
     dnspython_rcode.NOTZONE: 60  # Name not contained in zone
 }
 
+TTL_NEGATIVE_MAX = 60 * 60 * 3  # Cap on negative caching, per RFC 2308 section 5
+
+
+def get_key(name: dns.name.Name, rdtype: int, rdclass: int, flags: bytes) -> bytes:
+    """
+
+    Cache key for a parsed question (with key flags, see `get_key_flags`), matching the key taken from the wire.
+
+    """
+    return name.canonicalize().to_wire() + rdtype.to_bytes(2, 'big') + rdclass.to_bytes(2, 'big') + flags
+
+
+def get_key_flags(message: Message) -> bytes:
+    """
+
+    Cache key flags for a parsed message, matching those taken from the wire.
+
+    """
+    is_edns = message.edns >= 0
+    return dns_wire.make_key_flags(is_edns, is_edns and bool(message.ednsflags & dns.flags.DO), bool(message.flags & dns.flags.CD))
+
+
+def get_name(rdata) -> dns.name.Name:
+    """
+
+    Name an rdata points to, e.g. a CNAME or PTR target, taken from the parsed rdata rather than re-parsed from text where possible.
+
+    """
+    name = getattr(rdata, 'target', None)
+    if isinstance(name, dns.name.Name):
+        return name
+    return dns.name.from_text(rdata.to_text())
+
+
 @dataclass
 class BaseDNSData:
     """
@@ -80,23 +116,107 @@ class Response(BaseDNSData):
     def rcode_text(self) -> str:
         return dnspython_rcode.to_text(self.rcode)
 
+    @property
+    def soa(self) -> Optional[RRset]:
+        """
+
+        Get the SOA from the authority section, if present.
+
+        """
+        for rrset in self.message.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return rrset
+        return None
+
+    @property
+    def is_negative(self) -> bool:
+        """
+
+        Whether this is a negative answer (RFC 2308): NXDOMAIN, or NODATA, i.e. NOERROR with no records of the type asked for (though possibly a CNAME chain).
+
+        """
+        if self.rcode == dnspython_rcode.NXDOMAIN:
+            return True
+        if self.rcode != dnspython_rcode.NOERROR or not self.message.question:
+            return False
+
+        rdtype = self.message.question[0].rdtype
+        if rdtype == dns.rdatatype.ANY:
+            return not self.message.answer
+        return not any(rrset.rdtype == rdtype for rrset in self.message.answer)
+
+    @property
+    def ttl_negative(self) -> Optional[int]:
+        """
+
+        Negative caching TTL, per RFC 2308: the lesser of the SOA's own TTL and its MINIMUM field, if there is an SOA.
+
+        """
+        soa = self.soa
+        if not soa:
+            return None
+        return min(soa.ttl, soa[0].minimum, TTL_NEGATIVE_MAX)
+
     @property
     def ttl(self) -> int:
         """
 
-        Get median TTL from answers, falling back to authority, then to error-code defaults.
+        Get minimum TTL from answers (and, for negative answers, the SOA-derived negative TTL), falling back to authority, then to error-code defaults.
 
         """
-        answers = self.message.answer or self.message.authority
-        if answers:
-            ttls = [answer.ttl for answer in answers]
+        ttls = [answer.ttl for answer in self.message.answer]
+        if self.is_negative and (ttl_negative := self.ttl_negative) is not None:
+            ttls.append(ttl_negative)
+
+        ttls = ttls or [authority.ttl for authority in self.message.authority]
+        if ttls:
             ttl = min(ttls)
             return ttl
 
-        ttl = TTL_CODE_DEFAULTS.get(self.rcode, dnspython_rcode.NXDOMAIN)
+        ttl = TTL_CODE_DEFAULTS.get(self.rcode, TTL_CODE_DEFAULTS[dnspython_rcode.NXDOMAIN])
         return ttl
 
+    def with_id(self, id: int) -> Self:
+        """
 
+        Copy with a different message ID patched into the wire, e.g. to answer one of several coalesced requests.
+
+        """
+        wire = self.message.to_wire()
+        wire = id.to_bytes(2, 'big') + wire[2:]
+        return replace(self, wire=wire)
+
+    def get_chain(self, flags: bytes) -> List[Tuple[bytes, Self]]:
+        """
+
+        Responses for each intermediate CNAME target in the answer, keyed as if asked directly (with the original request's key flags), so they can be cached independently of the name that led to them.
+        Each carries the remainder of the chain. Targets with nothing beneath them are only included for NXDOMAIN, since an empty NOERROR might just be an unfollowed chain.
+
+        """
+        if not self.message.question or self.blocked_by:
+            return []
+
+        question = self.message.question[0]
+        answers = self.message.answer
+        name = question.name
+        chain = []
+
+        for index, rrset in enumerate(answers):
+            if rrset.rdtype != dns.rdatatype.CNAME or rrset.name != name:
+                continue
+            name = rrset[0].target
+            remainder = answers[index + 1:]
+            if not remainder and self.rcode != dnspython_rcode.NXDOMAIN:
+                break
+
+            message = dns.message.make_response(dns.message.make_query(name, question.rdtype, question.rdclass))
+            message.flags = self.message.flags
+            message.set_rcode(self.rcode)
+            message.answer = list(remainder)
+            message.authority = list(self.message.authority)
+            chain.append((get_key(name, question.rdtype, question.rdclass, flags), self.from_message(message)))
+
+        return chain
 
     def __str__(self):
         """
@@ -128,6 +248,19 @@ class Request(BaseDNSData):
     def question(self) -> RRset:
         return self.message.question[0]
 
+    @cached_property
+    def key(self) -> bytes:
+        """
+
+        Cache key, taken straight from the wire where possible, so it matches the key computed on the unparsed fast path.
+
+        """
+        try:
+            return dns_wire.get_key(self.wire)
+        except (ValueError, IndexError):
+            question = self.question
+            return get_key(question.name, question.rdtype, question.rdclass, get_key_flags(self.message))
+
     @cached_property
     def is_valid(self):
         return len(self.message.question) != 0
@@ -177,6 +310,10 @@ class Exchange:
     is_internal: bool = False
     client_name: Optional[str] = None
     is_complete: bool = False
+    writer: Optional[asyncio.StreamWriter] = field(default=None, repr=False)
+
+    question_memo: Optional[Tuple[RRset, RRset]] = field(default=None, init=False, repr=False, compare=False)
+    query_memo: Optional[Tuple[RRset, QueryMessage]] = field(default=None, init=False, repr=False, compare=False)
 
     @property
     def addr(self):
@@ -199,41 +336,57 @@ class Exchange:
         Create an RRset surrogate representing the latest/current question.
         This can be the original question - or a hybrid one if we've injected our own answers into the Exchange.
         If there's a response, use its answers, else fall back to answers_pre, else to the original question.
+        The surrogate is built from the already-parsed name, and memoised until the last answer changes.
 
         """
         answers = self.answers_pre
         if self.response:
             answers = self.response.message.answer or answers
 
-        if answers:
-            rrset = answers[-1]
-            rdtype = self.request.type
-            ttl = self.request.question.ttl
-            rdclass = self.request.question.rdclass
-            name = next(iter(rrset.items.keys())).to_text()
-            rrset_surrogate = dns.rrset.from_text(
-                name=name,
-                ttl=ttl,
-                rdtype=rdtype,
-                rdclass=rdclass,
-            )
-
-            return rrset_surrogate
-        else:
+        if not answers:
             return self.request.question
 
+        rrset = answers[-1]
+        if self.question_memo and self.question_memo[0] is rrset:
+            return self.question_memo[1]
+
+        question = self.request.question
+        rrset_surrogate = dns.rrset.RRset(get_name(rrset[0]), question.rdclass, question.rdtype)
+        rrset_surrogate.ttl = question.ttl
+
+        self.question_memo = rrset, rrset_surrogate
+        return rrset_surrogate
+
     @property
     def query_last(self) -> QueryMessage:
         """
 
-        Create a query (e.g. for use by upstream) based on the last question.
+        Create a query (e.g. for use by upstream) based on the last question, memoised until that question changes.
+        The request's EDNS, DO and CD settings are carried over, since they are part of the cache key, and the response should honour them.
 
         """
-
         question_last = self.question_last
-        query = dns.message.make_query(qname=question_last.name, rdclass=question_last.rdclass, rdtype=question_last.rdtype, id=self.request.message.id)
+        if self.query_memo and self.query_memo[0] is question_last:
+            return self.query_memo[1]
+
+        request = self.request.message
+        query = dns.message.make_query(
+            qname=question_last.name, rdclass=question_last.rdclass, rdtype=question_last.rdtype, id=request.id,
+            use_edns=request.edns if request.edns >= 0 else False, want_dnssec=bool(request.ednsflags & dns.flags.DO)
+        )
+        query.flags |= request.flags & dns.flags.CD
+        self.query_memo = question_last, query
         return query
 
+    @property
+    def is_chained(self) -> bool:
+        """
+
+        Whether the latest question differs from the original, e.g. it's the target of an injected CNAME.
+
+        """
+        return self.question_last is not self.request.question
+
     @property
     def key(self):
         """
@@ -241,8 +394,7 @@ class Exchange:
         Hashable key for caching
 
         """
-        data = tuple(self.request.question.to_text().split())
-        return data
+        return self.request.key
 
     @cached_property
     def reverse(self) -> Self:
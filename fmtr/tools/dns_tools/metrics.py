@@ -0,0 +1,200 @@
+"""
+
+Cheap in-process counters, gauges and histograms, exposed as Prometheus text. Recording is a dictionary update (plus a bisect for histograms), so it can run on every query.
+
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, Tuple, List, Callable
+
+from fmtr.tools.logging_tools import logger
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+BUCKETS_LATENCY = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Names:
+    """
+
+    Metric names.
+
+    """
+    REQUESTS = 'dns_requests_total'
+    CACHE = 'dns_cache_total'
+    RESPONSES = 'dns_responses_total'
+    SHED = 'dns_shed_total'
+    ERRORS = 'dns_errors_total'
+    REQUEST_SECONDS = 'dns_request_seconds'
+    STAGE_SECONDS = 'dns_stage_seconds'
+    UPSTREAM_SECONDS = 'dns_upstream_seconds'
+    UPSTREAM_ERRORS = 'dns_upstream_errors_total'
+    INFLIGHT = 'dns_inflight'
+    QUEUE_DEPTH = 'dns_queue_depth'
+    CACHE_SIZE = 'dns_cache_entries'
+    CACHE_BYTES = 'dns_cache_bytes'
+    CACHE_EVICTIONS = 'dns_cache_evictions_total'
+    CACHE_EXPIRATIONS = 'dns_cache_expirations_total'
+
+
+@dataclass
+class Histogram:
+    """
+
+    Fixed-bucket histogram. Counts are per bucket, and only made cumulative when rendered.
+
+    """
+    buckets: Tuple[float, ...] = BUCKETS_LATENCY
+    counts: List[int] = field(init=False)
+    sum: float = 0
+
+    def __post_init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def get_cumulative(self) -> List[Tuple[str, int]]:
+        """
+
+        Cumulative counts by upper bound, as Prometheus expects.
+
+        """
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        cumulative = []
+        total = 0
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    text = ','.join(f'{name}="{value}"' for name, value in labels)
+    return f'{{{text}}}'
+
+
+class Metrics:
+    """
+
+    Registry of counters, gauges and histograms, keyed by name and labels. Collectors are called just before rendering, to set any gauges that are cheaper to sample than to track.
+
+    """
+
+    def __init__(self):
+        self.counters: Dict[Key, float] = defaultdict(int)
+        self.gauges: Dict[Key, float] = defaultdict(int)
+        self.histograms: Dict[Key, Histogram] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def increment(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(labels.items()))] += value
+
+    def set_total(self, name: str, value: float, **labels):
+        """
+
+        Set a counter tracked elsewhere.
+
+        """
+        self.counters[(name, tuple(labels.items()))] = value
+
+    def add(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(labels.items()))] += value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        """
+
+        Observe the duration of the block.
+
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self) -> str:
+        """
+
+        Render all metrics in the Prometheus text exposition format.
+
+        """
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+        types = set()
+
+        def add_type(name, type):
+            if name not in types:
+                types.add(name)
+                lines.append(f'# TYPE {name} {type}')
+
+        for (name, labels), value in sorted(self.counters.items()):
+            add_type(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for (name, labels), value in sorted(self.gauges.items()):
+            add_type(name, 'gauge')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            add_type(name, 'histogram')
+            for bound, count in histogram.get_cumulative():
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+
+        Answer any HTTP request with the rendered metrics.
+
+        """
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = self.render().encode()
+            header = f'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'
+            writer.write(header.encode() + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> asyncio.Server:
+        """
+
+        Serve metrics over HTTP, for scraping.
+
+        """
+        server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return server
+
+
+metrics = Metrics()
@@ -1,7 +1,12 @@
+import asyncio
 from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
 
-from fmtr.tools.dns_tools import server, client
+from fmtr.tools.dns_tools import server, client, dm, wire as dns_wire, sampling
+from fmtr.tools.dns_tools.blocklist import Blocklist
 from fmtr.tools.dns_tools.dm import Exchange
+from fmtr.tools.dns_tools.metrics import metrics, Names
 from fmtr.tools.logging_tools import logger
 
 
@@ -13,7 +18,64 @@ class Proxy(server.Plain):
 
     """
 
-    client: client.HTTP
+    client: client.Client
+    blocklist: Optional[Blocklist] = None
+    blocklist_interval: Optional[timedelta] = None
+
+    async def start(self):
+        """
+
+        Load any blocklist (and keep it up to date) before serving.
+
+        """
+        if self.blocklist is not None:
+            await self.reload_blocklist()
+            if self.blocklist_interval:
+                self.create_task(self.reload_blocklist_periodically())
+
+        await super().start()
+
+    async def reload_blocklist(self):
+        """
+
+        Hot-reload the blocklist, then evict any cached responses whose blocked status has changed.
+
+        """
+        await self.blocklist.reload()
+
+        keys = []
+        for key in list(self.cache):
+            entry = self.cache.get(key)
+            if entry and self.blocklist.get_blocked_by(dns_wire.get_name_text(key)) != entry.blocked_by:
+                keys.append(key)
+
+        for key in keys:
+            self.cache.pop(key, None)
+
+        logger.info(f'Blocklist loaded {len(self.blocklist)=}. Evicted {len(keys)} cache entries.')
+
+    async def reload_blocklist_periodically(self):
+        while True:
+            await asyncio.sleep(self.blocklist_interval.total_seconds())
+            try:
+                await self.reload_blocklist()
+            except Exception as exception:
+                logger.exception(exception)
+
+    def process_blocklist(self, exchange: Exchange):
+        """
+
+        Blackhole requests for blocked names.
+
+        """
+        blocked_by = self.blocklist.get_blocked_by(exchange.request.name_text)
+        if not blocked_by:
+            return
+
+        response = exchange.request.blackhole
+        response.blocked_by = blocked_by
+        exchange.response = response
+        exchange.is_complete = True
 
     def process_question(self, exchange: Exchange):
         """
@@ -23,6 +85,27 @@ class Proxy(server.Plain):
         """
         return
 
+    def check_cache_chained(self, exchange: Exchange) -> bool:
+        """
+
+        If the question has moved on to a CNAME target (e.g. one injected while processing the question), answer it from any fresh cache entry for that target, instead of going upstream.
+
+        """
+        if not exchange.is_chained:
+            return False
+
+        query = exchange.query_last
+        question = query.question[0]
+        entry = self.cache.get(dm.get_key(question.name, question.rdtype, question.rdclass, dns_wire.get_key_flags(exchange.key)))
+        now = self.cache.timer()
+        if not entry or entry.is_stale(now):
+            return False
+
+        sampling.info('Chained question found in cache {name=}.', name=question.name)
+        metrics.increment(Names.CACHE, result='chained')
+        exchange.response = entry.get_response(now, query.to_wire())
+        return True
+
     def process_upstream(self, exchange: Exchange):
         """
 
@@ -42,21 +125,28 @@ class Proxy(server.Plain):
     async def resolve(self, exchange: Exchange) -> Exchange:
         """
 
-        Resolve a request, processing each stage, initial question, upstream response etc.
+        Resolve a request, processing each stage, initial question, upstream response etc., recording each stage's latency.
         Subclasses can override the relevant processing methods to implement custom behaviour.
 
         """
-        with logger.span(f'Processing question...'):
+        if self.blocklist is not None:
+            with sampling.span('Checking blocklist...'), metrics.time(Names.STAGE_SECONDS, stage='blocklist'):
+                self.process_blocklist(exchange)
+            if exchange.is_complete:
+                return exchange
+
+        with sampling.span('Processing question...'), metrics.time(Names.STAGE_SECONDS, stage='question'):
             self.process_question(exchange)
         if exchange.is_complete:
             return exchange
 
-        with logger.span(f'Making upstream request...'):
-            self.client.resolve(exchange)
+        with sampling.span('Making upstream request...'), metrics.time(Names.STAGE_SECONDS, stage='upstream'):
+            if not self.check_cache_chained(exchange):
+                await self.client.resolve(exchange)
         if exchange.is_complete:
             return exchange
 
-        with logger.span(f'Processing upstream response...'):
+        with sampling.span('Processing upstream response...'), metrics.time(Names.STAGE_SECONDS, stage='response'):
             self.process_upstream(exchange)
         if exchange.is_complete:
             return exchange
@@ -0,0 +1,116 @@
+"""
+
+Compact binary log of the query stream hitting a server, for replay (see `replay`). Each record is a timestamp, the client IP, the header flags and the question.
+
+"""
+import heapq
+import ipaddress
+import socket
+import struct
+import time
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, BinaryIO
+
+from fmtr.tools.dns_tools import wire as dns_wire
+from fmtr.tools.path_tools import Path
+
+MAGIC = b'FDQL\x01'
+RECORD = struct.Struct('!dHBH')  # timestamp, flags, IP length, question length
+SIZE_BUFFER = 64 * 1024
+
+
+@dataclass
+class Record:
+    """
+
+    One logged query.
+
+    """
+    timestamp: float
+    ip: str
+    flags: int
+    question: bytes
+
+    def to_wire(self, id: int) -> bytes:
+        """
+
+        Rebuild a query with the given message ID.
+
+        """
+        return dns_wire.HEADER.pack(id, self.flags, 1, 0, 0, 0) + self.question
+
+
+class Writer:
+    """
+
+    Appends records to a log file. Writes are buffered, so logging costs a struct pack and a buffer copy per query.
+
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.is_new = not self.path.exists() or self.path.stat().st_size == 0
+        self.file: Optional[BinaryIO] = None
+        self.count = 0
+
+    def open(self):
+        self.file = self.path.open('ab', buffering=SIZE_BUFFER)
+        if self.is_new:
+            self.file.write(MAGIC)
+
+    def write(self, data: bytes, ip: str, timestamp: Optional[float] = None):
+        """
+
+        Log a raw query. Malformed queries, with no parseable question, are skipped.
+
+        """
+        try:
+            question = dns_wire.get_question(data)
+        except (ValueError, IndexError):
+            return
+
+        if self.file is None:
+            self.open()
+
+        ip = ip.split('%')[0]  # Drop any IPv6 scope
+        address = socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+        flags = dns_wire.HEADER.unpack_from(data)[1]
+        self.file.write(RECORD.pack(timestamp or time.time(), flags, len(address), len(question)) + address + question)
+        self.count += 1
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read(path: Path) -> Iterator[Record]:
+    """
+
+    Read records from a log file, stopping at any truncated final record (e.g. from a log still being written).
+
+    """
+    with Path(path).open('rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'Not a query log: {str(path)}')
+
+        while len(fixed := file.read(RECORD.size)) == RECORD.size:
+            timestamp, flags, size_address, size_question = RECORD.unpack(fixed)
+            address = file.read(size_address)
+            question = file.read(size_question)
+            if len(question) != size_question:
+                return
+            yield Record(timestamp=timestamp, ip=str(ipaddress.ip_address(address)), flags=flags, question=question)
+
+
+def read_all(paths: List[Path]) -> Iterator[Record]:
+    """
+
+    Read records from several logs (e.g. one per worker process), merged into timestamp order.
+
+    """
+    return heapq.merge(*[read(path) for path in paths], key=lambda record: record.timestamp)
@@ -0,0 +1,130 @@
+"""
+
+Replay of query logs against a proxy in front of a local stand-in upstream, at original or accelerated speed, so cache policies, blocklists etc. can be compared offline on real traffic shapes.
+
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+from datetime import timedelta
+from typing import List
+
+from fmtr.tools.dns_tools import benchmark, querylog
+from fmtr.tools.dns_tools.blocklist import Blocklist
+from fmtr.tools.logging_tools import logger
+from fmtr.tools.path_tools import Path
+
+
+async def replay(records: List[querylog.Record], port: int, speed: float = 1.0, concurrency: int = 64) -> benchmark.Result:
+    """
+
+    Send the records to a running proxy, keeping their original spacing divided by `speed`, or as fast as possible if `speed` is zero.
+    At most `concurrency` queries are outstanding at once (so bursts are not lost to socket buffers), and the replay falls behind schedule rather than exceed it.
+    All queries come from a single socket, whatever the original client.
+
+    """
+    loop = asyncio.get_running_loop()
+    transport, generator = await loop.create_datagram_endpoint(benchmark.Generator, remote_addr=(benchmark.HOST, port))
+    result = benchmark.Result()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def wait(id: int, future: asyncio.Future):
+        try:
+            result.latencies.append(await asyncio.wait_for(future, benchmark.TIMEOUT))
+        except asyncio.TimeoutError:
+            generator.pending.pop(id, None)
+            result.timeouts += 1
+        finally:
+            semaphore.release()
+
+    waits = []
+    try:
+        start = time.perf_counter()
+        origin = records[0].timestamp if records else 0
+
+        for index, record in enumerate(records):
+            if speed:
+                delay = start + (record.timestamp - origin) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await semaphore.acquire()
+            id = index % 0x10000
+            future = loop.create_future()
+            generator.pending[id] = time.perf_counter(), future
+            transport.sendto(record.to_wire(id))
+            waits.append(loop.create_task(wait(id, future)))
+
+        await asyncio.gather(*waits)
+        result.duration = time.perf_counter() - start
+    finally:
+        transport.close()
+
+    return result
+
+
+def run(paths: List[Path], speed: float = 1.0, latency: float = 0.02, concurrency: int = 64, port: int = 5353, port_upstream: int = 5354, **kwargs) -> benchmark.Result:
+    """
+
+    Replay logs against a fresh proxy (with any extra `kwargs`, e.g. cache or blocklist settings) in front of a stand-in upstream with the given latency (in seconds).
+
+    """
+    records = list(querylog.read_all(paths))
+    logger.info(f'Loaded {len(records)} records from {len(paths)} logs.')
+
+    counter = multiprocessing.Value('q', 0)
+    stub = multiprocessing.Process(target=benchmark.run_stub, args=(port_upstream, latency, counter), daemon=True)
+    proxy = multiprocessing.Process(target=benchmark.run_proxy, args=(port, port_upstream), kwargs=kwargs, daemon=True)
+    stub.start()
+    proxy.start()
+
+    try:
+        asyncio.run(benchmark.wait_ready(port))
+        upstream, cpu = counter.value, benchmark.get_cpu(proxy.pid)
+        with logger.span(f'Replaying {len(records)} records {speed=}...'):
+            result = asyncio.run(replay(records, port, speed=speed, concurrency=concurrency))
+        result.upstream = counter.value - upstream
+        if cpu is not None:
+            result.cpu = benchmark.get_cpu(proxy.pid) - cpu
+    finally:
+        for process in [proxy, stub]:
+            process.terminate()
+            process.join()
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay DNS query logs against a proxy in front of a local stand-in upstream')
+    parser.add_argument('paths', nargs='+', type=Path, help='Query logs, e.g. one per worker')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier, or 0 for as fast as possible')
+    parser.add_argument('--latency', type=float, default=20, help='Upstream latency in milliseconds')
+    parser.add_argument('--concurrency', type=int, default=64, help='Maximum outstanding queries')
+    parser.add_argument('--cache-size', type=int, default=32 * 1024 * 1024, help='Cache size in bytes')
+    parser.add_argument('--stale', type=float, default=None, help='Serve stale answers for up to this many seconds')
+    parser.add_argument('--prefetch-hits', type=int, default=None, help='Refresh entries with at least this many hits ahead of expiry')
+    parser.add_argument('--blocklist', nargs='*', type=Path, default=None, help='Blocklist files')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--port-upstream', type=int, default=5354)
+
+    args = parser.parse_args()
+
+    result = run(
+        args.paths,
+        speed=args.speed,
+        latency=args.latency / 1e3,
+        concurrency=args.concurrency,
+        port=args.port,
+        port_upstream=args.port_upstream,
+        cache_size=args.cache_size,
+        stale=None if args.stale is None else timedelta(seconds=args.stale),
+        prefetch_hits=args.prefetch_hits,
+        blocklist=Blocklist(args.blocklist) if args.blocklist else None,
+    )
+
+    print(f'replay: {result}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+
+Sampled, structured logging for the DNS hot path. Whether a request is logged is decided once, up front, and carried in a context variable (so tasks it spawns follow suit).
+Unsampled requests create no spans and build no messages. Messages are templates, with the values passed as structured fields.
+
+"""
+from contextlib import nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Optional
+
+from fmtr.tools.logging_tools import logger
+
+is_sampled: ContextVar[bool] = ContextVar('is_sampled', default=True)
+
+NULL = nullcontext()
+
+
+def span(template: str, **fields):
+    """
+
+    Span for a sampled request, else a no-op context.
+
+    """
+    if not is_sampled.get():
+        return NULL
+    return logger.span(template, **fields)
+
+
+def info(template: str, **fields):
+    """
+
+    Info log for a sampled request, else nothing.
+
+    """
+    if not is_sampled.get():
+        return
+    logger.info(template, **fields)
+
+
+@dataclass
+class Sampler:
+    """
+
+    Samples 1-in-`every` requests for full logging. Unsampled requests are still logged, once, on completion, if they fail or are slower than `slow`.
+
+    """
+    every: int = 1
+    slow: Optional[timedelta] = timedelta(seconds=1)
+    count: int = 0
+
+    def sample(self) -> bool:
+        self.count += 1
+        return self.count % self.every == 0
+
+    def is_slow(self, duration: float) -> bool:
+        return self.slow is not None and duration >= self.slow.total_seconds()
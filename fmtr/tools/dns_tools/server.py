@@ -1,24 +1,107 @@
 import asyncio
+import multiprocessing
+import signal
+import time
 from dataclasses import dataclass, field
-from datetime import timedelta
+from datetime import timedelta, datetime
 from dns import rcode as dnspython_rcode
 from functools import cached_property
-from typing import Optional
+from typing import Optional, Dict, Set
 
 from fmtr.tools import caching_tools as caching
+from fmtr.tools.dns_tools import wire as dns_wire, sampling, querylog
+from fmtr.tools.dns_tools.cache import Cache, Entry
 from fmtr.tools.dns_tools.dm import Exchange
+from fmtr.tools.dns_tools.metrics import metrics, Names
 from fmtr.tools.logging_tools import logger
+from fmtr.tools.path_tools import Path
+
+
+class Overload:
+    """
+
+    Policies for requests that arrive when the queue is full.
+
+    """
+    SERVFAIL = 'servfail'
+    REFUSED = 'refused'
+    DROP = 'drop'
+    DROP_OLDEST = 'drop-oldest'
+
+
+OVERLOAD_RCODES = {
+    Overload.SERVFAIL: dnspython_rcode.SERVFAIL,
+    Overload.REFUSED: dnspython_rcode.REFUSED,
+}
+
+
+@dataclass
+class Load:
+    """
+
+    Load-shedding counters.
+
+    """
+    received: int = 0
+    shed: int = 0
+    errors: int = 0
+
+
+@dataclass
+class Connection:
+    """
+
+    TCP connection state: how many of its queries are still queued or being handled, and an event set whenever there are none.
+
+    """
+    pending: int = 0
+    idle: asyncio.Event = field(default_factory=asyncio.Event)
+
+    def __post_init__(self):
+        self.idle.set()
+
+    def add(self):
+        self.pending += 1
+        self.idle.clear()
+
+    def remove(self):
+        self.pending -= 1
+        if not self.pending:
+            self.idle.set()
 
 
 @dataclass(kw_only=True, eq=False)
 class Plain(asyncio.DatagramProtocol):
     """
 
-    Async base class for a plain DNS server using asyncio DatagramProtocol.
+    Async base class for a plain DNS server using asyncio DatagramProtocol, with a companion TCP listener sharing the same pipeline and cache.
     """
 
+    CLIENT_NAME_TTL = timedelta(minutes=10)
+    PAYLOAD_MAX = 1_232  # Largest UDP response, whatever the client advertises, to avoid fragmentation (DNS Flag Day 2020)
+    TCP_IDLE = timedelta(seconds=10)
+
     host: str
     port: int
+    stale: Optional[timedelta] = None
+    prefetch_hits: Optional[int] = None
+    prefetch_fraction: float = 0.9
+    cache_size: int = 32 * 1024 * 1024
+    snapshot: Optional[Path] = None
+    snapshot_interval: timedelta = timedelta(minutes=5)
+    workers: int = 1
+    shared: Optional[Path] = None
+    concurrency: int = 256
+    queue_size: int = 1_024
+    overload: str = Overload.SERVFAIL
+    tcp: bool = True
+    log_every: int = 1
+    log_slow: Optional[timedelta] = timedelta(seconds=1)
+    metrics_host: str = '127.0.0.1'
+    metrics_port: Optional[int] = None
+    query_log: Optional[Path] = None
+    query_log_interval: timedelta = timedelta(seconds=5)
+    worker: int = field(default=0, init=False)
     transport: Optional[asyncio.DatagramTransport] = field(default=None, init=False)
 
     @cached_property
@@ -30,32 +113,467 @@ class Plain(asyncio.DatagramProtocol):
     def cache(self):
         """
 
-        Overridable cache.
+        Overridable cache, of up to `cache_size` bytes. Honours response TTLs, serving expired answers for up to `stale` while they are refreshed, and refreshing popular entries ahead of expiry.
+        """
+        cache = Cache(maxsize=self.cache_size, stale=self.stale, prefetch_hits=self.prefetch_hits, prefetch_fraction=self.prefetch_fraction)
+        return cache
+
+    @cached_property
+    def disk(self) -> Optional[caching.Disk]:
+        """
+
+        On-disk cache snapshot, if enabled.
+
+        """
+        if not self.snapshot:
+            return None
+        return caching.Disk(self.snapshot)
+
+    @cached_property
+    def cache_shared(self) -> Optional[caching.Disk]:
+        """
+
+        On-disk cache shared between worker processes, if enabled. Best placed on tmpfs.
+
+        """
+        if not self.shared:
+            return None
+        return caching.Disk(self.shared)
+
+    async def check_cache_shared(self, key) -> Optional[Entry]:
+        """
+
+        Promote an entry from the shared cache into the local one. The read runs in a thread, as it's disk I/O.
+
+        """
+        if self.cache_shared is None:
+            return None
+
+        record = await asyncio.to_thread(self.cache_shared.get, key)
+        if not record:
+            return None
+
+        return self.cache.load_record(key, record)
+
+    def write_shared(self, key, record):
+        """
+
+        Write a record to the shared cache, to expire along with its entry.
+
+        """
+        self.cache_shared.set(key, record, expire=record['expires'] - time.time())
+
+    def store(self, key, response):
+        """
+
+        Cache a response locally, and in the shared cache (in a thread) if enabled.
+
+        """
+        entry = self.cache.store(key, response)
+        if entry is None or self.cache_shared is None:
+            return
+
+        record = self.cache.get_record(key, entry)
+        task = self.create_task(asyncio.to_thread(self.write_shared, key, record))
+        task.add_done_callback(self.log_task_exception)
+
+    def log_task_exception(self, task: asyncio.Task):
+        """
+
+        Log the failure of a fire-and-forget task, which nothing else would retrieve.
+
+        """
+        if not task.cancelled() and (exception := task.exception()):
+            logger.exception(exception)
+
+    def load_snapshot(self):
+        """
+
+        Warm the cache from the on-disk snapshot.
+
+        """
+        with logger.span(f'Loading cache snapshot {str(self.snapshot)=}...'):
+            records = {key: self.disk.get(key) for key in self.disk}
+            records = {key: record for key, record in records.items() if record}
+            count = self.cache.load_snapshot(records)
+            logger.info(f'Restored {count} of {len(records)} cache entries.')
+
+    def write_snapshot(self, records):
+        """
+
+        Replace the on-disk snapshot. Each record expires from disk along with its entry.
+
+        """
+        now = time.time()
+        with self.disk.transact():
+            self.disk.clear()
+            for key, record in records.items():
+                self.disk.set(key, record, expire=record['expires'] - now)
+
+    async def save_snapshot(self):
+        """
+
+        Snapshot the cache. Records are taken on the loop, but written to disk in a thread.
+
+        """
+        records = self.cache.get_snapshot()
+        with logger.span(f'Saving cache snapshot {len(records)=} {str(self.snapshot)=}...'):
+            await asyncio.to_thread(self.write_snapshot, records)
+
+    async def snapshot_periodically(self):
+        """
+
+        Keep the on-disk snapshot up to date.
+
+        """
+        while True:
+            await asyncio.sleep(self.snapshot_interval.total_seconds())
+            try:
+                await self.save_snapshot()
+            except Exception as exception:
+                logger.exception(exception)
+
+    @cached_property
+    def query_log_writer(self) -> Optional[querylog.Writer]:
+        """
+
+        Query log, if enabled. With multiple workers, each writes its own, suffixed with its number, as appends from separate processes could interleave.
+
         """
-        cache = caching.TLRU(maxsize=1_024, ttu_static=timedelta(hours=1), desc='DNS Request')
+        if not self.query_log:
+            return None
+        path = Path(self.query_log)
+        if self.workers > 1:
+            path = path.with_name(f'{path.stem}-{self.worker}{path.suffix}')
+        logger.info(f'Logging queries to {str(path)}')
+        return querylog.Writer(path)
+
+    async def flush_query_log_periodically(self):
+        """
+
+        Flush the query log every `query_log_interval`, so quiet periods still reach disk and the log can be tailed.
+
+        """
+        while True:
+            await asyncio.sleep(self.query_log_interval.total_seconds())
+            try:
+                self.query_log_writer.flush()
+            except Exception as exception:
+                logger.exception(exception)
+
+    @cached_property
+    def client_names(self):
+        """
+
+        Client names by IP, with the time they were last refreshed. Entries outlive their refresh TTL, so the previous name is served while a refresh runs.
+        """
+        cache = caching.TLRU(maxsize=1_024, ttu_static=timedelta(days=1), desc='Client Name')
         return cache
 
+    @cached_property
+    def tasks(self) -> Set[asyncio.Task]:
+        """
+
+        Strong references to background tasks, so they aren't garbage-collected mid-flight.
+
+        """
+        return set()
+
+    def create_task(self, coro) -> asyncio.Task:
+        """
+
+        Run a coroutine in the background.
+
+        """
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    @cached_property
+    def load(self) -> Load:
+        return Load()
+
+    @cached_property
+    def sampler(self) -> sampling.Sampler:
+        """
+
+        Request logging sampler. By default every request is logged. With `log_every` of N, only 1-in-N are, plus any that fail or are slower than `log_slow`.
+
+        """
+        return sampling.Sampler(every=self.log_every, slow=self.log_slow)
+
+    @cached_property
+    def queue(self) -> asyncio.Queue:
+        """
+
+        Requests waiting for a free handler. Bounds memory and in-flight work under bursts or slow upstreams.
+
+        """
+        return asyncio.Queue(maxsize=self.queue_size)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def collect_metrics(self):
+        """
+
+        Sample gauges at scrape time.
+
+        """
+        metrics.set(Names.QUEUE_DEPTH, self.queue_depth)
+        metrics.set(Names.CACHE_SIZE, len(self.cache))
+        metrics.set(Names.CACHE_BYTES, self.cache.currsize)
+        metrics.set_total(Names.CACHE_EVICTIONS, self.cache.stats.evictions)
+        metrics.set_total(Names.CACHE_EXPIRATIONS, self.cache.stats.expirations)
+
+    @cached_property
+    def connections(self) -> Dict[asyncio.StreamWriter, Connection]:
+        """
+
+        Open TCP connections, by writer.
+
+        """
+        return {}
+
+    def release(self, writer: Optional[asyncio.StreamWriter]):
+        """
+
+        Mark one of a TCP connection's queries as done with, answered or not.
+
+        """
+        if writer is not None and (connection := self.connections.get(writer)):
+            connection.remove()
+
+    @cached_property
+    def inflight(self) -> Dict[bytes, asyncio.Future]:
+        """
+
+        Upstream resolutions currently in flight, by request key.
+
+        """
+        return {}
+
     def connection_made(self, transport: asyncio.DatagramTransport):
         self.transport = transport
         logger.info(f'Listening on {self.host}:{self.port}')
 
     def datagram_received(self, data: bytes, addr):
-        ip, port = addr
-        exchange = Exchange.from_wire(data, ip=ip, port=port)
-        asyncio.create_task(self.handle(exchange))
+        if self.query_log_writer is not None:
+            self.query_log_writer.write(data, addr[0])
+
+        if self.answer_wire(data, addr):
+            return
+
+        self.enqueue(data, addr)
+
+    async def handle_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+
+        Serve a TCP connection: any number of length-prefixed queries, possibly pipelined, each answered as soon as it is ready (RFC 7766), until the client closes or goes idle.
+        Reading pauses while the client isn't reading its answers, so they can't pile up unbounded. Queries still outstanding when the client closes its side are answered before the connection is closed.
+
+        """
+        addr = writer.get_extra_info('peername')[:2]
+        connection = self.connections[writer] = Connection()
+        try:
+            while True:
+                size = await asyncio.wait_for(reader.readexactly(2), self.TCP_IDLE.total_seconds())
+                data = await reader.readexactly(int.from_bytes(size, 'big'))
+                if self.query_log_writer is not None:
+                    self.query_log_writer.write(data, addr[0])
+                if not self.answer_wire(data, addr, writer=writer):
+                    self.enqueue(data, addr, writer=writer)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            try:
+                await asyncio.wait_for(connection.idle.wait(), self.TCP_IDLE.total_seconds())
+                await writer.drain()
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            finally:
+                del self.connections[writer]
+                writer.close()
+
+    def send(self, wire: bytes, request: bytes, addr, writer: Optional[asyncio.StreamWriter] = None):
+        """
+
+        Send a response over TCP if the request came that way. Otherwise send it over UDP, truncated (with TC set) only if it exceeds what the client can accept.
+
+        """
+        if writer is not None:
+            if not writer.is_closing():
+                writer.write(len(wire).to_bytes(2, 'big') + wire)
+            return
+
+        if len(wire) > dns_wire.SIZE_UDP:
+            size = dns_wire.get_payload_size(request)
+            if size is None:
+                wire = dns_wire.truncate(wire)
+            elif len(wire) > min(max(size, dns_wire.SIZE_UDP), self.PAYLOAD_MAX):
+                wire = dns_wire.truncate(wire, size_edns=self.PAYLOAD_MAX)
+
+        self.transport.sendto(wire, addr)
+
+    def enqueue(self, data: bytes, addr, writer: Optional[asyncio.StreamWriter] = None):
+        """
+
+        Queue a request for handling, applying the overload policy if the queue is full. Anything without a full header, or that is itself a response, is dropped, never answered.
+
+        """
+        self.load.received += 1
+
+        if len(data) < dns_wire.SIZE_HEADER or dns_wire.HEADER.unpack_from(data)[1] & dns_wire.FLAG_QR:
+            self.load.errors += 1
+            metrics.increment(Names.ERRORS)
+            return
+
+        if self.queue.full():
+            self.load.shed += 1
+            metrics.increment(Names.SHED, policy=self.overload)
+
+            if self.overload == Overload.DROP_OLDEST:
+                _, _, writer_oldest = self.queue.get_nowait()
+                self.release(writer_oldest)
+            else:
+                rcode = OVERLOAD_RCODES.get(self.overload)
+                if rcode and len(data) >= dns_wire.SIZE_HEADER:
+                    self.send(dns_wire.make_error(data, rcode), data, addr, writer)
+                return
+
+        self.queue.put_nowait((data, addr, writer))
+        if writer is not None:
+            self.connections[writer].add()
+
+    async def work(self):
+        """
+
+        Handle queued requests, one at a time. Runs `concurrency` of these. Requests that cannot be parsed are answered FORMERR.
+
+        """
+        while True:
+            data, addr, writer = await self.queue.get()
+            ip, port = addr
+
+            try:
+                try:
+                    exchange = Exchange.from_wire(data, ip=ip, port=port, writer=writer)
+                except Exception as exception:
+                    self.load.errors += 1
+                    metrics.increment(Names.ERRORS)
+                    logger.debug(f'Malformed request {exception=}')
+                    self.send(dns_wire.make_error(data, dnspython_rcode.FORMERR), data, addr, writer)
+                    continue
+
+                try:
+                    await self.handle(exchange)
+                except Exception as exception:
+                    self.load.errors += 1
+                    metrics.increment(Names.ERRORS)
+                    logger.exception(exception)
+            finally:
+                self.release(writer)
+
+    def start_worker(self):
+        task = self.create_task(self.work())
+        task.add_done_callback(self.restart_worker)
+
+    def restart_worker(self, task: asyncio.Task):
+        """
+
+        Replace a worker that died, so handling capacity never drains away.
+
+        """
+        if task.cancelled():
+            return
+        logger.error(f'Worker died. Restarting... {task.exception()=}')
+        self.start_worker()
 
     async def start(self):
         """
 
-        Start the async UDP server.
+        Start the async UDP server. SIGTERM stops it cleanly, so the final snapshot and query log flush still happen.
         """
 
-        logger.info(f'Starting async DNS server on {self.host}:{self.port}...')
+        logger.info(f'Starting async DNS server on {self.host}:{self.port} {self.worker=}...')
+
+        is_snapshotter = self.disk is not None and self.worker == 0  # With multiple workers, only the first writes snapshots.
+
+        if self.disk is not None:
+            self.load_snapshot()
+        if is_snapshotter:
+            self.create_task(self.snapshot_periodically())
+        if self.query_log_writer is not None:
+            self.create_task(self.flush_query_log_periodically())
+
+        try:
+            self.loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)  # Shut down cleanly, below, rather than be killed outright.
+        except (NotImplementedError, RuntimeError, ValueError):  # Not supported on this platform, or not the main thread.
+            pass
+
+        for _ in range(self.concurrency):
+            self.start_worker()
+
+        if self.metrics_port is not None:
+            metrics.collectors.append(self.collect_metrics)
+            await metrics.serve(self.metrics_host, self.metrics_port + self.worker)  # One endpoint per worker, as their metrics are separate.
+
         await self.loop.create_datagram_endpoint(
             lambda: self,
-            local_addr=(self.host, self.port)
+            local_addr=(self.host, self.port),
+            reuse_port=self.workers > 1,
         )
-        await asyncio.Future()  # Prevent exit by blocking forever
+
+        if self.tcp:
+            await asyncio.start_server(self.handle_tcp, self.host, self.port, reuse_port=self.workers > 1)
+            logger.info(f'Listening on {self.host}:{self.port} (TCP)')
+
+        try:
+            await asyncio.Future()  # Prevent exit by blocking forever
+        finally:
+            if is_snapshotter:
+                self.write_snapshot(self.cache.get_snapshot())
+            if self.query_log_writer is not None:
+                self.query_log_writer.close()
+
+    def run_worker(self, worker: int):
+        """
+
+        Run the server in this (worker) process.
+
+        """
+        self.worker = worker
+        try:
+            asyncio.run(self.start())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            return
+
+    def run(self):
+        """
+
+        Run the server. With multiple workers, each is a forked process bound to the same port via SO_REUSEPORT, so the kernel spreads queries across them.
+        Worker caches are separate, so set `shared` to keep hit rates up. Must be called before the loop, cache etc. are initialised, so none of it is inherited.
+
+        """
+        if self.workers <= 1:
+            return self.run_worker(0)
+
+        logger.info(f'Starting {self.workers} worker processes...')
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=self.run_worker, args=[worker], name=f'{self.__class__.__name__}-{worker}') for worker in range(self.workers)]
+
+        for process in processes:
+            process.start()
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
 
     async def resolve(self, exchange: Exchange) -> Exchange:
         """
@@ -65,24 +583,181 @@ class Plain(asyncio.DatagramProtocol):
         """
         raise NotImplementedError
 
-    def check_cache(self, exchange: Exchange):
-        if exchange.key in self.cache:
-            logger.info(f'Request found in cache.')
-            exchange.response = self.cache[exchange.key]
-            exchange.response.message.id = exchange.request.message.id
+    async def resolve_coalesced(self, exchange: Exchange) -> Exchange:
+        """
+
+        Resolve and cache, but only the first of any concurrent identical requests goes upstream. The rest wait on its result, patched with their own message IDs.
+        Intermediate CNAME targets are cached too, so later chains through them can be answered locally.
+
+        """
+        key = exchange.key
+        future = self.inflight.get(key)
+
+        if future:
+            sampling.info('Joining in-flight request.')
+            response = await asyncio.shield(future)
+            exchange.response = response.with_id(exchange.request.message.id)
             exchange.is_complete = True
+            return exchange
+
+        future = self.inflight[key] = self.loop.create_future()
+        try:
+            exchange = await self.resolve(exchange)
+            self.store(key, exchange.response)
+            for key_chain, response in exchange.response.get_chain(dns_wire.get_key_flags(key)):
+                self.store(key_chain, response)
+            future.set_result(exchange.response)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as exception:
+            future.set_exception(exception)
+            future.exception()  # Mark as retrieved, in case there were no waiters.
+            raise
+        finally:
+            del self.inflight[key]
+
+        return exchange
+
+    async def refresh(self, exchange: Exchange):
+        """
 
-    def get_span(self, exchange: Exchange):
+        Re-resolve a request in the background, e.g. to replace a stale cache entry.
+
+        """
+        exchange = Exchange.from_wire(exchange.request.wire, ip=exchange.ip, port=exchange.port, is_internal=True)
+        try:
+            await self.resolve_coalesced(exchange)
+        except Exception as exception:
+            logger.exception(exception)
+            if entry := self.cache.get(exchange.key):
+                entry.is_refreshing = False
+
+    def answer_wire(self, data: bytes, addr, writer: Optional[asyncio.StreamWriter] = None) -> bool:
+        """
+
+        Fast path: answer plain cache hits directly from wire bytes, without parsing the request, building an Exchange or logging.
+        Anything else (misses, entries due for refresh, unusual queries) falls through to the full handler.
+
+        """
+        try:
+            key = dns_wire.get_key(data)
+        except (ValueError, IndexError):
+            return False
+
+        entry = self.cache.get(key)
+        if not entry:
+            return False
+
+        now = self.cache.timer()
+        if self.cache.is_refresh_due(entry, now):
+            return False
+
+        entry.hits += 1
+        self.cache.stats.hits += 1
+        self.send(entry.get_wire(now, data), data, addr, writer)
+
+        metrics.increment(Names.REQUESTS, path='fast')
+        metrics.increment(Names.CACHE, result='hit')
+        metrics.increment(Names.RESPONSES, rcode=dnspython_rcode.to_text(entry.rcode))
+        return True
+
+    async def check_cache(self, exchange: Exchange):
+        """
+
+        Answer from cache, with remaining TTLs. Stale and hot, nearly-expired entries are still served, while a refresh runs in the background.
+        Names beneath a cached NXDOMAIN are answered NXDOMAIN too, without caching each one, so floods of junk names neither reach upstream nor churn the cache.
+
+        """
+        key = exchange.key
+        entry = self.cache.get(key) or await self.check_cache_shared(key)
+        now = self.cache.timer()
+
+        if not entry:
+            if entry := self.cache.get_nxdomain(key, now):
+                self.cache.stats.hits += 1
+                metrics.increment(Names.CACHE, result='synthesized')
+                sampling.info('Name is beneath a cached NXDOMAIN.')
+                exchange.response = entry.get_response_synthesized(now, exchange.request)
+                exchange.is_complete = True
+                return
+
+            self.cache.stats.misses += 1
+            metrics.increment(Names.CACHE, result='miss')
+            return
+
+        self.cache.stats.hits += 1
+        metrics.increment(Names.CACHE, result='hit')
+
+        entry.hits += 1
+        sampling.info('Request found in cache {hits=}.', hits=entry.hits)
+        exchange.response = entry.get_response(now, exchange.request.wire)
+        exchange.is_complete = True
+
+        if self.cache.is_refresh_due(entry, now) and key not in self.inflight:
+            sampling.info('Refreshing cache entry in background {is_stale=}...', is_stale=entry.is_stale(now))
+            entry.is_refreshing = True
+            self.create_task(self.refresh(exchange))
+
+    def get_client_name(self, exchange: Exchange) -> Optional[str]:
+        """
+
+        Get the cached client name, scheduling a background refresh if it is missing or due. Never waits on the reverse lookup itself.
+
+        """
+        now = datetime.now()
+        client_name, refreshed = self.client_names.get(exchange.ip, (None, None))
+
+        if refreshed is None or now - refreshed > self.CLIENT_NAME_TTL:
+            self.client_names[exchange.ip] = client_name, now  # Claim the refresh, so only one is scheduled per IP.
+            self.create_task(self.refresh_client_name(exchange))
+
+        return client_name
+
+    async def refresh_client_name(self, exchange: Exchange):
         """
 
-        Get handling span
+        Resolve the client name via a reverse lookup of its IP.
+
+        """
+        reverse = exchange.reverse
+
+        try:
+            await self.handle(reverse)
+        except Exception as exception:
+            logger.exception(exception)
+            return
+
+        client_name = reverse.question_last.name.to_text()
+        if not reverse.response.answer:
+            logger.warning(f'Client name could not be resolved {client_name=}.')
+
+        self.client_names[exchange.ip] = client_name, datetime.now()
+
+    def get_fields(self, exchange: Exchange) -> Dict:
+        """
+
+        Structured logging fields for an exchange.
 
         """
         request = exchange.request
-        span = logger.span(
-            f'Handling request {exchange.client_name=} {request.message.id=} {request.type_text} {request.name_text} {request.question=}...'
-        )
-        return span
+        fields = dict(client_name=exchange.client_name, id=request.message.id, type=request.type_text, name=request.name_text)
+
+        response = exchange.response
+        if exchange.is_complete and response:
+            fields |= dict(rcode=response.rcode_text, answer=str(response.answer), blocked_by=response.blocked_by)
+
+        return fields
+
+    def get_span(self, exchange: Exchange):
+        """
+
+        Get handling span. Fields are only built for sampled requests, as rendering answers etc. is the expensive part.
+
+        """
+        if not sampling.is_sampled.get():
+            return sampling.NULL
+        return sampling.span('Handling request {type} {name} {client_name=} {id=}...', **self.get_fields(exchange))
 
     def log_response(self, exchange: Exchange):
         """
@@ -90,11 +765,9 @@ class Plain(asyncio.DatagramProtocol):
         Log when resolution complete
 
         """
-        request = exchange.request
-        response = exchange.response
-        logger.info(
-            f'Resolution complete {exchange.client_name=} {request.message.id=} {request.type_text} {request.name_text} {request.question=} {exchange.is_complete=} {response.rcode=} {response.rcode_text=} {response.answer=} {response.blocked_by=}...'
-        )
+        if not sampling.is_sampled.get():
+            return
+        sampling.info('Resolution complete {type} {name} {rcode} {answer=} {blocked_by=}...', **self.get_fields(exchange))
 
     def log_dns_errors(self, exchange: Exchange):
         """
@@ -102,37 +775,59 @@ class Plain(asyncio.DatagramProtocol):
         Warn about any errors
 
         """
-        if exchange.response.rcode != dnspython_rcode.NOERROR:
-            logger.warning(f'Error {exchange.response.rcode_text=}')
+        if sampling.is_sampled.get() and exchange.response.rcode != dnspython_rcode.NOERROR:
+            logger.warning('Error {rcode}', rcode=exchange.response.rcode_text)
+
+    def log_unsampled(self, exchange: Exchange, duration: float):
+        """
+
+        Log an unsampled request, if it failed or was slow.
+
+        """
+        is_error = exchange.response.rcode not in {dnspython_rcode.NOERROR, dnspython_rcode.NXDOMAIN}
+        if is_error or self.sampler.is_slow(duration):
+            logger.warning('Failed or slow request {type} {name} {rcode} {duration=:.3f}s', duration=duration, **self.get_fields(exchange))
 
     async def handle(self, exchange: Exchange):
         """
 
-        Warn about any errors
+        Handle a request end-to-end: cache, resolution, logging and reply. Records the in-flight gauge, request latency and response codes.
 
         """
         if not exchange.request.is_valid:
             raise ValueError(f'Only one question per request is supported. Got {len(exchange.request.question)} questions.')
 
         if not exchange.is_internal:
-            await self.handle(exchange.reverse)
-            client_name = exchange.reverse.question_last.name.to_text()
-            if not exchange.reverse.response.answer:
-                logger.warning(f'Client name could not be resolved {client_name=}.')
-            exchange.client_name = client_name
+            exchange.client_name = self.get_client_name(exchange)
+
+        is_sampled = self.sampler.sample()
+        token = sampling.is_sampled.set(is_sampled)
+
+        start = time.perf_counter()
+        metrics.add(Names.INFLIGHT, 1)
+        try:
+            with self.get_span(exchange):
+                with sampling.span('Checking cache...'), metrics.time(Names.STAGE_SECONDS, stage='cache'):
+                    await self.check_cache(exchange)
+
+                if not exchange.is_complete:
+                    exchange = await self.resolve_coalesced(exchange)
 
-        with self.get_span(exchange):
-            with logger.span(f'Checking cache...'):
-                self.check_cache(exchange)
+                self.log_dns_errors(exchange)
+                self.log_response(exchange)
+        finally:
+            metrics.add(Names.INFLIGHT, -1)
+            sampling.is_sampled.reset(token)
 
-            if not exchange.is_complete:
-                exchange = await self.resolve(exchange)
-                self.cache[exchange.key] = exchange.response
+        duration = time.perf_counter() - start
+        if not is_sampled:
+            self.log_unsampled(exchange, duration)
 
-            self.log_dns_errors(exchange)
-            self.log_response(exchange)
+        metrics.increment(Names.REQUESTS, path='internal' if exchange.is_internal else 'full')
+        metrics.increment(Names.RESPONSES, rcode=exchange.response.rcode_text)
+        metrics.observe(Names.REQUEST_SECONDS, duration)
 
         if exchange.is_internal:
             return
 
-        self.transport.sendto(exchange.response.message.to_wire(), exchange.addr)
+        self.send(exchange.response.message.to_wire(), exchange.request.wire, exchange.addr, exchange.writer)
@@ -0,0 +1,257 @@
+"""
+
+Minimal DNS wire-format helpers, for hot paths where a full dnspython parse/serialise is too expensive.
+
+"""
+import struct
+from typing import Tuple, List, Iterator, Optional
+
+HEADER = struct.Struct('!HHHHHH')
+RR_FIXED = struct.Struct('!HHIH')  # type, class, TTL, rdlength
+TTL = struct.Struct('!I')
+
+SIZE_HEADER = HEADER.size
+SIZE_UDP = 512  # Maximum UDP message size without EDNS0
+OFFSET_TTL = 4  # TTL position within the fixed part of a resource record
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+FLAG_CD = 0x0010
+FLAG_DO = 0x8000  # In the OPT record's TTL field
+MASK_OPCODE = 0x7800
+MASK_RCODE = 0x000F
+
+TYPE_OPT = 41
+
+KEY_EDNS = 0x01
+KEY_DO = 0x02
+KEY_CD = 0x04
+SIZE_KEY_FLAGS = 1
+
+
+def skip_name(wire: bytes, offset: int) -> int:
+    """
+
+    Get the offset just past the (possibly compressed) name starting at `offset`.
+
+    """
+    while True:
+        length = wire[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:  # Compression pointer: always terminates the name.
+            return offset + 2
+        if length & 0xC0:
+            raise ValueError(f'Unsupported label type {length=}')
+        offset += length + 1
+
+
+def get_question(wire: bytes) -> bytes:
+    """
+
+    Get the (first) question section of a message, with the name lower-cased.
+
+    """
+    offset = SIZE_HEADER
+    while length := wire[offset]:
+        if length & 0xC0:
+            raise ValueError(f'Unexpected compression in question {length=}')
+        offset += length + 1
+    offset += 1
+
+    end = offset + 4
+    if end > len(wire):
+        raise ValueError(f'Truncated question {len(wire)=}')
+
+    question = wire[SIZE_HEADER:offset].lower() + wire[offset:end]
+    return question
+
+
+def make_key_flags(is_edns: bool, is_do: bool, is_cd: bool) -> bytes:
+    """
+
+    Cache key suffix for the request flags that change what a response may contain: EDNS presence (whether it may carry an OPT record), DO (DNSSEC records) and CD (unvalidated data).
+
+    """
+    return bytes([KEY_EDNS * is_edns | KEY_DO * is_do | KEY_CD * is_cd])
+
+
+def get_key(wire: bytes) -> bytes:
+    """
+
+    Cache key from a raw query: the question section, with the name lower-cased, followed by the key flags.
+
+    """
+    if len(wire) < SIZE_HEADER:
+        raise ValueError(f'Message too short {len(wire)=}')
+
+    id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(wire)
+    if flags & (FLAG_QR | MASK_OPCODE) or qdcount != 1:
+        raise ValueError(f'Not a standard single-question query {flags=} {qdcount=}')
+
+    opt = get_opt(wire)
+    is_edns = opt is not None
+    return get_question(wire) + make_key_flags(is_edns, is_edns and bool(opt[1] & FLAG_DO), bool(flags & FLAG_CD))
+
+
+def get_key_name(key: bytes) -> bytes:
+    """
+
+    Get the (lower-cased) wire-format name from a cache key.
+
+    """
+    return key[:-(4 + SIZE_KEY_FLAGS)]
+
+
+def get_key_flags(key: bytes) -> bytes:
+    """
+
+    Get the flags suffix from a cache key.
+
+    """
+    return key[-SIZE_KEY_FLAGS:]
+
+
+def get_name_text(key: bytes) -> str:
+    """
+
+    Get the (lower-cased) name text from a cache key.
+
+    """
+    labels = []
+    offset = 0
+    while length := key[offset]:
+        labels.append(key[offset + 1:offset + 1 + length].decode(errors='replace'))
+        offset += length + 1
+    return '.'.join(labels) + '.'
+
+
+def iter_names(name: bytes) -> Iterator[bytes]:
+    """
+
+    Yield an (uncompressed) wire-format name and each of its parents, excluding the root, e.g. `a.b.com`, `b.com`, `com`.
+
+    """
+    offset = 0
+    while length := name[offset]:
+        yield name[offset:]
+        offset += length + 1
+
+
+def get_ttls(wire: bytes) -> List[Tuple[int, int]]:
+    """
+
+    Get the offset and value of every record TTL in a message (excluding EDNS OPT pseudo-records, whose TTL field holds flags).
+
+    """
+    id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(wire)
+
+    offset = SIZE_HEADER
+    for _ in range(qdcount):
+        offset = skip_name(wire, offset) + 4
+
+    ttls = []
+    for _ in range(ancount + nscount + arcount):
+        offset = skip_name(wire, offset)
+        type, _class, ttl, rdlength = RR_FIXED.unpack_from(wire, offset)
+        if type != TYPE_OPT:
+            ttls.append((offset + OFFSET_TTL, ttl))
+        offset += RR_FIXED.size + rdlength
+
+    return ttls
+
+
+def patch(wire: bytes, request: bytes, ttls: List[Tuple[int, int]], age: int = 0, ttl_override: int | None = None) -> bytearray:
+    """
+
+    Copy a cached response for a new request: take over its ID and question (preserving the client's name casing), and decrement TTLs by `age`, or set them to `ttl_override`.
+
+    """
+    end = SIZE_HEADER + len(get_question(request))
+
+    wire = bytearray(wire)
+    wire[0:2] = request[0:2]
+    wire[SIZE_HEADER:end] = request[SIZE_HEADER:end]
+
+    for offset, ttl in ttls:
+        ttl = ttl_override if ttl_override is not None else max(ttl - age, 0)
+        TTL.pack_into(wire, offset, ttl)
+
+    return wire
+
+
+def make_error(request: bytes, rcode: int) -> bytes:
+    """
+
+    Build a minimal error response (e.g. SERVFAIL, REFUSED) to a raw request, echoing its ID and question.
+
+    """
+    id, flags, *_ = HEADER.unpack_from(request)
+
+    try:
+        end = SIZE_HEADER + len(get_key(request)) - SIZE_KEY_FLAGS
+        qdcount = 1
+    except (ValueError, IndexError):
+        end = SIZE_HEADER
+        qdcount = 0
+
+    flags = (flags & (MASK_OPCODE | FLAG_RD)) | FLAG_QR | FLAG_RA | rcode
+    return HEADER.pack(id, flags, qdcount, 0, 0, 0) + request[SIZE_HEADER:end]
+
+
+def get_opt(wire: bytes) -> Optional[Tuple[int, int]]:
+    """
+
+    Get the UDP payload size and flags (the TTL field) of a query's EDNS0 OPT record, if it has one (and is well-formed).
+
+    """
+    try:
+        id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(wire)
+
+        offset = SIZE_HEADER
+        for _ in range(qdcount):
+            offset = skip_name(wire, offset) + 4
+
+        for _ in range(ancount + nscount + arcount):
+            offset = skip_name(wire, offset)
+            type, size, ttl, rdlength = RR_FIXED.unpack_from(wire, offset)
+            if type == TYPE_OPT:
+                return size, ttl
+            offset += RR_FIXED.size + rdlength
+    except (ValueError, IndexError, struct.error):
+        return None
+
+    return None
+
+
+def get_payload_size(wire: bytes) -> Optional[int]:
+    """
+
+    Get the UDP payload size advertised in a query's EDNS0 OPT record, if it has one (and is well-formed).
+
+    """
+    opt = get_opt(wire)
+    if opt is None:
+        return None
+    return opt[0]
+
+
+def truncate(wire: bytes, size_edns: int | None = None) -> bytes:
+    """
+
+    Cut a response down to its header and question, with TC set, telling the client to retry over TCP. If `size_edns` is given, an OPT record advertising it is included.
+
+    """
+    id, flags, qdcount, *_ = HEADER.unpack_from(wire)
+
+    end = SIZE_HEADER
+    for _ in range(qdcount):
+        end = skip_name(wire, end) + 4
+
+    opt = b''
+    if size_edns is not None:
+        opt = b'\x00' + RR_FIXED.pack(TYPE_OPT, size_edns, 0, 0)
+
+    return HEADER.pack(id, flags | FLAG_TC, qdcount, 0, 0, int(bool(opt))) + wire[SIZE_HEADER:end] + opt
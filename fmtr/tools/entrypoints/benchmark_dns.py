@@ -0,0 +1,8 @@
+def main():
+    """
+
+    Benchmark the DNS proxy against a local stand-in upstream
+
+    """
+    from fmtr.tools.dns_tools import benchmark
+    benchmark.main()
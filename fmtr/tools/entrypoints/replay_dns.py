@@ -0,0 +1,8 @@
+def main():
+    """
+
+    Replay DNS query logs against a proxy in front of a local stand-in upstream
+
+    """
+    from fmtr.tools.dns_tools import replay
+    replay.main()
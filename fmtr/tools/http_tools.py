@@ -43,6 +43,42 @@ class Client(httpx.Client):
         )
 
 
+class AsyncClient(httpx.AsyncClient):
+    """
+
+    Instrumented async client base
+
+    """
+
+    TIMEOUT = 10
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, transport=self.transport, timeout=self.TIMEOUT, **kwargs)
+
+    @cached_property
+    def transport(self) -> RetryTransport:
+        """
+
+        Default Transport with retry
+
+        """
+        return RetryTransport(
+            retry=self.retry
+        )
+
+    @cached_property
+    def retry(self) -> Retry:
+        """
+
+        Default Retry
+
+        """
+        return Retry(
+            allowed_methods=Retry.RETRYABLE_METHODS,
+            backoff_factor=1.0
+        )
+
+
 client = Client()
 
 if __name__ == '__main__':
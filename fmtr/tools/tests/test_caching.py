@@ -0,0 +1,238 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta, datetime
+
+from fmtr.tools import caching_tools as caching
+from fmtr.tools.tests import helpers
+
+
+@helpers.parametrize(
+    'kwargs, expected',
+    [
+        (dict(), 2),
+        (dict(ttl=timedelta(seconds=0)), 3),
+    ]
+)
+def test_memoize_sync(kwargs, expected):
+    calls = []
+
+    @caching.memoize(**kwargs)
+    def double(value, factor=2):
+        calls.append(value)
+        return value * factor
+
+    assert double(3) == 6
+    assert double(3) == 6
+    assert double(3, factor=3) == 9
+    assert len(calls) == expected
+
+
+def test_memoize_disk(tmp_path):
+    calls = []
+
+    def get(value):
+        calls.append(value)
+        return {'value': value}
+
+    cache = caching.Disk(tmp_path / 'cache')
+    memoized = caching.memoize(cache=cache, ttl=timedelta(minutes=1))(get)
+    assert memoized(1) == memoized(1) == {'value': 1}
+    assert len(cache) == 1
+
+    memoized = caching.memoize(cache=cache, ttl=timedelta(minutes=1))(get)
+    assert memoized(1) == {'value': 1}
+    assert calls == [1]
+
+
+def test_memoize_bare_method():
+    class Counter:
+        def __init__(self):
+            self.count = 0
+
+        @caching.memoize
+        def get(self, value):
+            self.count += 1
+            return value
+
+    counter = Counter()
+    assert [counter.get(1), counter.get(1), counter.get(2)] == [1, 1, 2]
+    assert counter.count == 2
+
+
+def test_memoize_threads_deduplicated():
+    calls = []
+
+    @caching.memoize
+    def slow(value):
+        calls.append(value)
+        time.sleep(0.1)
+        return value
+
+    threads = [threading.Thread(target=slow, args=(1,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [1]
+
+
+def test_memoize_async_deduplicated():
+    calls = []
+
+    @caching.memoize
+    async def slow(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value
+
+    async def main():
+        return await asyncio.gather(*[slow(1) for _ in range(8)], slow(2))
+
+    assert asyncio.run(main()) == [1] * 8 + [2]
+    assert calls == [1, 2]
+
+
+def test_memoize_async_stale():
+    calls = []
+
+    @caching.memoize(ttl=timedelta(seconds=0.05), stale=timedelta(seconds=10))
+    async def get():
+        calls.append(None)
+        return len(calls)
+
+    async def main():
+        first = await get()
+        await asyncio.sleep(0.1)
+        stale = await get()
+        await asyncio.sleep(0.01)
+        refreshed = await get()
+        return first, stale, refreshed
+
+    assert asyncio.run(main()) == (1, 1, 2)
+
+
+def test_concurrent_tlru_capacity():
+    cache = caching.ConcurrentTLRU(maxsize=64, shards=4, ttu_static=timedelta(minutes=1))
+
+    def work(offset):
+        for index in range(200):
+            cache[offset + index] = index
+            cache.get(offset + index // 2)
+
+    threads = [threading.Thread(target=work, args=(offset * 10_000,)) for offset in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) == len(list(cache)) <= cache.maxsize == 64
+    assert all(key in cache for key in cache)
+
+
+def test_concurrent_tlru_get_or_set():
+    cache = caching.ConcurrentTLRU(ttu_static=timedelta(minutes=1))
+    calls = []
+
+    def factory():
+        calls.append(None)
+        time.sleep(0.05)
+        return 'value'
+
+    threads = [threading.Thread(target=cache.get_or_set, args=('key', factory)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cache['key'] == 'value'
+    assert len(calls) == 1
+
+
+def test_tiered(tmp_path):
+    disk = caching.Disk(tmp_path / 'cache')
+    with caching.Tiered(caching.TLRU(maxsize=2), disk, batch=1_000, interval=timedelta(minutes=1)) as cache:
+        for index in range(4):
+            cache[index] = index * 10
+
+        assert len(disk) == 0
+        assert cache[0] == 0  # Evicted from memory, but not yet flushed
+        cache.flush()
+        assert sorted(disk) == [0, 1, 2, 3]
+
+        del cache[1]
+        assert 1 not in cache
+        assert cache[3] == 30
+
+    assert sorted(disk) == [0, 2, 3]
+
+    cache = caching.Tiered(caching.TLRU(maxsize=2), disk)
+    assert cache[2] == 20
+    assert 2 in cache.memory
+
+
+def test_concurrent_tlru_items_expiring():
+    now = [datetime(2000, 1, 1)]
+    cache = caching.ConcurrentTLRU(timer=lambda: now[0], ttu_static=timedelta(seconds=10), shards=4)
+    for index in range(8):
+        cache[index] = index
+
+    items = []
+    for key, value in cache.items():
+        now[0] += timedelta(seconds=20)  # Everything else expires mid-iteration
+        items.append((key, value))
+
+    assert sorted(items) == [(index, index) for index in range(8)]
+    assert list(cache.values()) == []
+
+
+def test_tiered_flush_visible(tmp_path):
+    disk = caching.Disk(tmp_path / 'cache')
+    disk['key'] = 'old'
+    transact = disk.transact
+
+    @contextmanager
+    def transact_slow():
+        with transact():
+            yield
+            time.sleep(0.2)  # Written, but not yet committed
+
+    disk.transact = transact_slow
+    cache = caching.Tiered(caching.TLRU(maxsize=1), disk, interval=timedelta(minutes=1))
+    cache['key'] = 'new'
+    cache['other'] = 'value'  # Evicts the new value from memory
+
+    thread = threading.Thread(target=cache.flush)
+    thread.start()
+    time.sleep(0.05)
+    assert cache['key'] == 'new'
+    thread.join()
+
+    assert cache['key'] == 'new'
+    assert disk['key'] == 'new'
+    cache.close()
+
+
+def test_memoize_async_disk_off_loop(tmp_path):
+    threads = set()
+
+    class Disk(caching.Disk):
+        def get(self, *args, **kwargs):
+            threads.add(threading.current_thread())
+            return super().get(*args, **kwargs)
+
+        def set(self, *args, **kwargs):
+            threads.add(threading.current_thread())
+            return super().set(*args, **kwargs)
+
+    @caching.memoize(cache=Disk(tmp_path / 'cache'), ttl=timedelta(minutes=1))
+    async def get(value):
+        return value
+
+    async def main():
+        return [await get(1), await get(1)]
+
+    assert asyncio.run(main()) == [1, 1]
+    assert threads and threading.main_thread() not in threads
@@ -0,0 +1,699 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import time
+from unittest import mock
+from datetime import timedelta
+from contextlib import asynccontextmanager
+
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rrset
+import httpx
+import pytest
+
+from fmtr.tools.dns_tools import wire, blocklist, metrics, cache, querylog, client, dm
+from fmtr.tools.dns_tools.proxy import Proxy
+from fmtr.tools.dns_tools.dm import Request, Response, Exchange
+from fmtr.tools.tests import helpers
+
+
+def get_response(query):
+    response = dns.message.make_response(query)
+    response.answer.append(dns.rrset.from_text(query.question[0].name, 300, 'IN', 'CNAME', 'target.example.com.'))
+    response.answer.append(dns.rrset.from_text('target.example.com.', 60, 'IN', 'A', '192.0.2.1'))
+    response.authority.append(dns.rrset.from_text('example.com.', 3600, 'IN', 'NS', 'ns.example.com.'))
+    return response
+
+
+def get_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Static(client.Client):
+    """
+
+    Stand-in upstream client, answering every query with the same address, after an optional delay.
+
+    """
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.count = 0
+
+    async def query(self, query):
+        self.count += 1
+        await asyncio.sleep(self.delay)
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(query.question[0].name, 60, 'IN', 'A', '192.0.2.1'))
+        return Response.from_message(response)
+
+
+@asynccontextmanager
+async def serve(**kwargs):
+    """
+
+    Run a proxy (in front of a Static client, by default) on a free port, for the duration of the block.
+
+    """
+    kwargs = dict(client=Static(), log_every=1_000) | kwargs
+    proxy = Proxy(host='127.0.0.1', port=get_port(), **kwargs)
+    task = asyncio.create_task(proxy.start())
+    while proxy.transport is None:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+    try:
+        yield proxy
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        proxy.transport.close()
+
+
+@helpers.parametrize(
+    'name_a, name_b',
+    [
+        ('www.example.com.', 'WWW.Example.COM.'),
+        ('a.b.c.', 'A.b.C.'),
+    ]
+)
+def test_key_case_insensitive(name_a, name_b):
+    key_a = wire.get_key(dns.message.make_query(name_a, 'A').to_wire())
+    key_b = wire.get_key(dns.message.make_query(name_b, 'A').to_wire())
+    assert key_a == key_b
+
+
+def test_key_type_sensitive():
+    key_a = wire.get_key(dns.message.make_query('example.com.', 'A').to_wire())
+    key_aaaa = wire.get_key(dns.message.make_query('example.com.', 'AAAA').to_wire())
+    assert key_a != key_aaaa
+
+
+def test_key_matches_parsed():
+    query = dns.message.make_query('Mixed.Example.com.', 'HTTPS')
+    request = Request(query.to_wire())
+    assert request.key == wire.get_key(query.to_wire())
+
+
+def make_query_flagged(use_edns, want_dnssec, is_cd):
+    query = dns.message.make_query('www.example.com.', 'A', use_edns=use_edns, want_dnssec=want_dnssec)
+    if is_cd:
+        query.flags |= dns.flags.CD
+    return query
+
+
+FLAGGED = [(False, False, False), (0, False, False), (0, True, False), (False, False, True), (0, True, True)]
+
+
+def test_key_flags_sensitive():
+    keys = {wire.get_key(make_query_flagged(*flags).to_wire()) for flags in FLAGGED}
+    assert len(keys) == len(FLAGGED)
+
+
+@helpers.parametrize('flags', FLAGGED)
+def test_key_flags_matches_parsed(flags):
+    query = make_query_flagged(*flags)
+    question = query.question[0]
+    assert wire.get_key(query.to_wire()) == dm.get_key(question.name, question.rdtype, question.rdclass, dm.get_key_flags(query))
+
+
+@helpers.parametrize('flags', FLAGGED)
+def test_query_last_flags(flags):
+    query = make_query_flagged(*flags)
+    exchange = Exchange.from_wire(query.to_wire(), ip='127.0.0.1', port=53)
+    assert wire.get_key(exchange.query_last.to_wire()) == exchange.key
+
+
+def test_get_ttls():
+    query = dns.message.make_query('www.example.com.', 'A', use_edns=0)
+    response = get_response(query)
+    response.use_edns(0)
+    ttls = [ttl for offset, ttl in wire.get_ttls(response.to_wire())]
+    assert ttls == [300, 60, 3600]
+
+
+def test_patch():
+    query_cached = dns.message.make_query('www.example.com.', 'A')
+    response = get_response(query_cached).to_wire()
+    ttls = wire.get_ttls(response)
+
+    query = dns.message.make_query('WWW.example.COM.', 'A')
+    patched = dns.message.from_wire(bytes(wire.patch(response, query.to_wire(), ttls, age=10)))
+
+    assert patched.id == query.id
+    assert patched.question[0].name.to_text() == 'WWW.example.COM.'
+    assert [rrset.ttl for rrset in patched.answer + patched.authority] == [290, 50, 3590]
+
+
+def test_patch_ttl_override():
+    query = dns.message.make_query('www.example.com.', 'A')
+    response = get_response(query).to_wire()
+    patched = dns.message.from_wire(bytes(wire.patch(response, query.to_wire(), wire.get_ttls(response), age=10_000, ttl_override=30)))
+    assert {rrset.ttl for rrset in patched.answer + patched.authority} == {30}
+
+
+@helpers.parametrize(
+    'rcode',
+    [dns.rcode.SERVFAIL, dns.rcode.REFUSED]
+)
+def test_make_error(rcode):
+    query = dns.message.make_query('www.example.com.', 'A')
+    response = dns.message.from_wire(wire.make_error(query.to_wire(), rcode))
+    assert response.id == query.id
+    assert response.rcode() == rcode
+    assert response.question == query.question
+    assert not response.answer
+
+
+@helpers.parametrize(
+    'line, expected',
+    [
+        ('0.0.0.0 ads.example.com tracker.example.com', ['ads.example.com', 'tracker.example.com']),
+        ('127.0.0.1 localhost', []),
+        ('||Ads.Example.com^', ['ads.example.com']),
+        ('||ads.example.com^$third-party', []),
+        ('||example.com/path^', []),
+        ('ads.example.com # trailing comment', ['ads.example.com']),
+        ('# comment', []),
+        ('! adblock comment', []),
+        ('@@||ads.example.com^', []),
+    ]
+)
+def test_blocklist_parse_line(line, expected):
+    assert list(blocklist.parse_line(line)) == expected
+
+
+@helpers.parametrize(
+    'name, expected',
+    [
+        ('ads.example.com.', 'ads'),
+        ('x.y.ADS.example.com.', 'ads'),
+        ('example.com.', None),
+        ('ok.ads.example.com.', None),
+        ('sub.ok.ads.example.com.', None),
+    ]
+)
+def test_blocklist_blocked_by(tmp_path, name, expected):
+    path = tmp_path / 'ads.txt'
+    path.write_text('0.0.0.0 ads.example.com\n')
+    engine = blocklist.Blocklist([path], allow=['ok.ads.example.com'])
+    engine.load()
+    assert engine.get_blocked_by(name) == expected
+
+
+def test_metrics_render():
+    registry = metrics.Metrics()
+    registry.increment(metrics.Names.CACHE, result='hit')
+    registry.increment(metrics.Names.CACHE, result='hit')
+    registry.observe(metrics.Names.STAGE_SECONDS, 0.003, stage='upstream')
+    registry.observe(metrics.Names.STAGE_SECONDS, 20, stage='upstream')
+
+    lines = registry.render().splitlines()
+    assert 'dns_cache_total{result="hit"} 2' in lines
+    assert 'dns_stage_seconds_bucket{stage="upstream",le="0.0025"} 0' in lines
+    assert 'dns_stage_seconds_bucket{stage="upstream",le="0.005"} 1' in lines
+    assert 'dns_stage_seconds_bucket{stage="upstream",le="+Inf"} 2' in lines
+    assert 'dns_stage_seconds_count{stage="upstream"} 2' in lines
+
+
+@helpers.parametrize(
+    'rcode, answers, expected',
+    [
+        (dns.rcode.NXDOMAIN, [], 30),
+        (dns.rcode.NOERROR, [], 30),
+        (dns.rcode.NOERROR, [('CNAME', 20, 'target.example.com.')], 20),
+        (dns.rcode.NOERROR, [('A', 120, '192.0.2.1')], 120),
+    ]
+)
+def test_response_ttl_negative(rcode, answers, expected):
+    query = dns.message.make_query('name.example.com.', 'A')
+    message = dns.message.make_response(query)
+    message.set_rcode(rcode)
+    for rdtype, ttl, rdata in answers:
+        message.answer.append(dns.rrset.from_text('name.example.com.', ttl, 'IN', rdtype, rdata))
+    message.authority.append(dns.rrset.from_text('example.com.', 300, 'IN', 'SOA', 'ns. host. 1 2 3 4 30'))
+    assert Response.from_message(message).ttl == expected
+
+
+def test_iter_names():
+    name = dns.name.from_text('a.b.com.').to_wire()
+    assert [dns.name.from_wire(parent, 0)[0].to_text() for parent in wire.iter_names(name)] == ['a.b.com.', 'b.com.', 'com.']
+
+
+@helpers.parametrize(
+    'kwargs, expected',
+    [
+        (dict(), None),
+        (dict(use_edns=0, payload=4096), 4096),
+    ]
+)
+def test_get_payload_size(kwargs, expected):
+    assert wire.get_payload_size(dns.message.make_query('example.com.', 'A', **kwargs).to_wire()) == expected
+
+
+def test_truncate():
+    query = dns.message.make_query('name.example.com.', 'A')
+    truncated = dns.message.from_wire(wire.truncate(get_response(query).to_wire(), size_edns=1232))
+    assert truncated.flags & dns.flags.TC
+    assert truncated.question == query.question
+    assert not truncated.answer and not truncated.authority
+    assert truncated.payload == 1232
+
+
+def test_cache_byte_budget():
+    responses = {}
+    for index in range(10):
+        query = dns.message.make_query(f'name{index}.example.com.', 'A')
+        responses[Request(query.to_wire()).key] = Response.from_message(get_response(query))
+
+    size = cache.Entry.from_response(next(iter(responses.values())), stored=0, ttl_max=3600).size
+    store = cache.Cache(maxsize=size * 4)
+    for key, response in responses.items():
+        store.store(key, response)
+
+    assert len(store) == 4
+    assert store.currsize <= store.maxsize
+    assert store.stats.evictions == 6
+
+
+def test_response_chain():
+    query = dns.message.make_query('www.example.com.', 'A')
+    message = dns.message.make_response(query)
+    message.answer.append(dns.rrset.from_text('www.example.com.', 300, 'IN', 'CNAME', 'cdn.example.net.'))
+    message.answer.append(dns.rrset.from_text('cdn.example.net.', 300, 'IN', 'CNAME', 'edge.example.org.'))
+    message.answer.append(dns.rrset.from_text('edge.example.org.', 60, 'IN', 'A', '192.0.2.1'))
+
+    chain = Response.from_message(message).get_chain(wire.get_key_flags(wire.get_key(query.to_wire())))
+    targets = {key: response for key, response in chain}
+    key = Request(dns.message.make_query('EDGE.example.org.', 'A').to_wire()).key
+
+    assert len(chain) == 2
+    assert [rrset.to_text() for rrset in targets[key].message.answer] == ['edge.example.org. 60 IN A 192.0.2.1']
+
+
+def test_question_last_memoised():
+    query = dns.message.make_query('www.example.com.', 'A')
+    exchange = Exchange.from_wire(query.to_wire(), ip='127.0.0.1', port=53)
+    assert exchange.question_last is exchange.request.question
+    assert not exchange.is_chained
+
+    exchange.answers_pre.append(dns.rrset.from_text('www.example.com.', 300, 'IN', 'CNAME', 'target.example.com.'))
+    question = exchange.question_last
+    assert question.name.to_text() == 'target.example.com.'
+    assert exchange.question_last is question
+    assert exchange.query_last is exchange.query_last
+    assert exchange.query_last.id == query.id
+
+
+def test_querylog_roundtrip(tmp_path):
+    path = tmp_path / 'queries.log'
+    queries = [(dns.message.make_query('www.example.com.', 'A'), '192.0.2.1'), (dns.message.make_query('Other.example.com.', 'AAAA'), '2001:db8::1')]
+
+    writer = querylog.Writer(path)
+    for index, (query, ip) in enumerate(queries):
+        writer.write(query.to_wire(), ip, timestamp=1000 + index)
+    writer.write(b'junk', '192.0.2.1')
+    writer.close()
+
+    records = list(querylog.read(path))
+    assert [(record.timestamp, record.ip) for record in records] == [(1000, '192.0.2.1'), (1001, '2001:db8::1')]
+    for record, (query, ip) in zip(records, queries):
+        replayed = dns.message.from_wire(record.to_wire(7))
+        assert replayed.id == 7
+        assert replayed.flags == query.flags
+        assert wire.get_key(replayed.to_wire()) == wire.get_key(query.to_wire())
+
+
+@helpers.parametrize(
+    'answers, is_indexed',
+    [
+        ([], True),
+        ([('CNAME', 'gone.example.net.')], False),
+    ]
+)
+def test_cache_nxdomain_index(answers, is_indexed):
+    query = dns.message.make_query('alias.example.com.', 'A')
+    message = dns.message.make_response(query)
+    message.set_rcode(dns.rcode.NXDOMAIN)
+    for rdtype, rdata in answers:
+        message.answer.append(dns.rrset.from_text('alias.example.com.', 300, 'IN', rdtype, rdata))
+    message.authority.append(dns.rrset.from_text('example.net.', 300, 'IN', 'SOA', 'ns. host. 1 2 3 4 30'))
+
+    store = cache.Cache()
+    store.store(Request(query.to_wire()).key, Response.from_message(message))
+
+    for name, rdtype in [('alias.example.com.', 'AAAA'), ('sub.alias.example.com.', 'A')]:
+        key = Request(dns.message.make_query(name, rdtype).to_wire()).key
+        assert (store.get_nxdomain(key, store.timer()) is not None) == is_indexed
+
+
+def test_server_survives_malformed():
+    query = dns.message.make_query('www.example.com.', 'A')
+    junk = query.to_wire()[:12] + b'\xffjunk'
+    response = dns.message.make_response(query).to_wire()
+
+    async def main():
+        async with serve(concurrency=2) as proxy:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            loop = asyncio.get_running_loop()
+            await loop.sock_connect(sock, ('127.0.0.1', proxy.port))
+            for data in [junk, junk, junk, response, b'\x00']:
+                await loop.sock_sendall(sock, data)
+            errors = [await asyncio.wait_for(loop.sock_recv(sock, 512), 1) for _ in range(3)]
+            sock.close()
+
+            answer = await dns.asyncquery.udp(query, '127.0.0.1', port=proxy.port, timeout=2)
+            return errors, answer
+
+    errors, answer = asyncio.run(main())
+    assert {dns.message.from_wire(error).rcode() for error in errors} == {dns.rcode.FORMERR}
+    assert answer.answer[0][0].address == '192.0.2.1'
+
+
+def test_server_shared_cache(tmp_path):
+    class Failing(client.Client):
+        async def query(self, query):
+            raise ConnectionError('Upstream unreachable')
+
+    query = dns.message.make_query('shared.example.com.', 'A')
+
+    async def main():
+        async with serve(shared=tmp_path / 'shared') as proxy:
+            await dns.asyncquery.udp(query, '127.0.0.1', port=proxy.port, timeout=2)
+            await asyncio.sleep(0.2)  # Shared writes are in the background
+
+        async with serve(shared=tmp_path / 'shared', client=Failing()) as proxy:
+            return await dns.asyncquery.udp(query, '127.0.0.1', port=proxy.port, timeout=2)
+
+    answer = asyncio.run(main())
+    assert answer.rcode() == dns.rcode.NOERROR
+    assert answer.answer[0][0].address == '192.0.2.1'
+
+
+def run_proxy(port, **kwargs):
+    Proxy(host='127.0.0.1', port=port, client=Static(), tcp=False, log_every=1_000, **kwargs).run()
+
+
+def test_server_query_log_flushed(tmp_path):
+    path = tmp_path / 'queries.log'
+    port = get_port()
+    process = multiprocessing.get_context('fork').Process(target=run_proxy, args=(port,), kwargs=dict(query_log=path, query_log_interval=timedelta(seconds=0.2)))
+    process.start()
+
+    try:
+        for _ in range(50):
+            try:
+                dns.query.udp(dns.message.make_query('first.example.com.', 'A'), '127.0.0.1', port=port, timeout=0.2)
+                break
+            except dns.exception.Timeout:
+                continue
+        time.sleep(0.5)
+        assert 'first.example.com.' in [dns.name.from_wire(record.to_wire(0), 12)[0].to_text() for record in querylog.read(path)]
+
+        dns.query.udp(dns.message.make_query('last.example.com.', 'A'), '127.0.0.1', port=port, timeout=2)
+    finally:
+        process.terminate()
+        process.join()
+
+    names = [dns.name.from_wire(record.to_wire(0), 12)[0].to_text() for record in querylog.read(path)]
+    assert names[-1] == 'last.example.com.'
+
+
+def get_children(pid: int):
+    with open(f'/proc/{pid}/task/{pid}/children') as file:
+        return [int(child) for child in file.read().split()]
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def query_until_up(port: int, name: str):
+    for _ in range(50):
+        try:
+            return dns.query.udp(dns.message.make_query(name, 'A'), '127.0.0.1', port=port, timeout=0.2)
+        except dns.exception.Timeout:
+            continue
+    raise TimeoutError(f'Server on {port=} never answered')
+
+
+def test_server_workers_terminated(tmp_path):
+    path = tmp_path / 'queries.log'
+    port = get_port()
+    process = multiprocessing.get_context('fork').Process(target=run_proxy, args=(port,), kwargs=dict(workers=2, query_log=path, query_log_interval=timedelta(minutes=1)))
+    process.start()
+
+    children = []
+    try:
+        query_until_up(port, 'first.example.com.')
+        children = get_children(process.pid)
+        for index in range(10):
+            dns.query.udp(dns.message.make_query(f'name{index}.example.com.', 'A'), '127.0.0.1', port=port, timeout=2)
+    finally:
+        process.terminate()
+        process.join(5)
+        alive = [child for child in children if is_alive(child)]
+        for pid in alive + [process.pid] * process.is_alive():
+            os.kill(pid, signal.SIGKILL)
+        process.join()
+
+    assert len(children) == 2
+    assert not alive
+    assert process.exitcode == 0
+
+    names = {dns.name.from_wire(record.to_wire(0), 12)[0].to_text() for record in querylog.read_all(sorted(tmp_path.glob('queries-*.log')))}
+    assert {f'name{index}.example.com.' for index in range(10)} <= names
+
+
+def test_server_tcp_pipelined_half_close():
+    names = [f'name{index}.example.com.' for index in range(5)]
+
+    async def main():
+        async with serve(client=Static(delay=0.2)) as proxy:
+            reader, writer = await asyncio.open_connection('127.0.0.1', proxy.port)
+            for name in names:
+                data = dns.message.make_query(name, 'A').to_wire()
+                writer.write(len(data).to_bytes(2, 'big') + data)
+            writer.write_eof()
+
+            answers = []
+            for _ in names:
+                size = await asyncio.wait_for(reader.readexactly(2), 2)
+                answers.append(dns.message.from_wire(await reader.readexactly(int.from_bytes(size, 'big'))))
+            writer.close()
+            return answers
+
+    answers = asyncio.run(main())
+    assert sorted(answer.question[0].name.to_text() for answer in answers) == names
+
+
+@pytest.mark.skipif(not shutil.which('openssl'), reason='Needs openssl to make a test certificate')
+def test_tls_pipelined_malformed(tmp_path):
+    # Local DoT stub, answering pipelined queries in reverse order, each preceded by a malformed frame under the same ID.
+    cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=dot.test', '-addext', 'subjectAltName=DNS:dot.test', '-keyout', key, '-out', cert],
+        check=True, capture_output=True
+    )
+    context_server = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context_server.load_cert_chain(cert, key)
+
+    names = [f'name{index}.example.com.' for index in range(3)]
+
+    async def handle(reader, writer):
+        queries = []
+        for _ in names:
+            size = await reader.readexactly(2)
+            queries.append(dns.message.from_wire(await reader.readexactly(int.from_bytes(size, 'big'))))
+        for query in reversed(queries):
+            junk = query.id.to_bytes(2, 'big') + b'\x81\x80\x00\x01' + b'\x00' * 6 + b'\x3f'
+            data = get_response(query).to_wire()
+            writer.write(len(junk).to_bytes(2, 'big') + junk + len(data).to_bytes(2, 'big') + data)
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, ssl=context_server)
+        port = server.sockets[0].getsockname()[1]
+        upstream = client.TLS(host='127.0.0.1', port=port, hostname='dot.test', ssl_context=ssl.create_default_context(cafile=cert))
+        async with server:
+            responses = await asyncio.gather(*[upstream.query(dns.message.make_query(name, 'A')) for name in names])
+            for connection in upstream.connections:
+                connection.writer.close()
+            return responses
+
+    responses = asyncio.run(main())
+    assert [response.message.question[0].name.to_text() for response in responses] == names
+    assert len({response.message.answer[0].name.to_text() for response in responses}) == len(names)
+
+
+class Reversing(asyncio.DatagramProtocol):
+    """
+
+    Stand-in UDP upstream, holding queries until it has `count`, then answering them in reverse order.
+
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self.queries = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries.append((dns.message.from_wire(data), addr))
+        if len(self.queries) < self.count:
+            return
+        for query, addr in reversed(self.queries):
+            self.transport.sendto(get_response(query).to_wire(), addr)
+        self.queries.clear()
+
+
+def test_plain_multiplexed():
+    names = [f'name{index}.example.com.' for index in range(5)]
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        transport, stub = await loop.create_datagram_endpoint(lambda: Reversing(len(names)), local_addr=('127.0.0.1', 0))
+        upstream = client.Plain(host='127.0.0.1', port=transport.get_extra_info('sockname')[1])
+        upstream.SOCKETS = 1
+        try:
+            return await asyncio.gather(*[upstream.query(dns.message.make_query(name, 'A')) for name in names])
+        finally:
+            transport.close()
+
+    responses = asyncio.run(main())
+    assert [response.message.question[0].name.to_text() for response in responses] == names
+
+
+def test_plain_unreachable():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    async def main():
+        upstream = client.Plain(host='127.0.0.1', port=port)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(upstream.query(dns.message.make_query('www.example.com.', 'A')), 1)
+        return upstream.sockets
+
+    sockets = asyncio.run(main())
+    assert all(socket.is_closed for socket in sockets)
+
+
+class Flaky(Static):
+    """
+
+    Stand-in upstream client, failing until told otherwise.
+
+    """
+    is_failing = True
+
+    async def query(self, query):
+        if self.is_failing:
+            self.count += 1
+            raise ConnectionError('Upstream unreachable')
+        return await super().query(query)
+
+
+def test_pool_hedge():
+    slow, fast = Static(delay=2), Static()
+
+    async def main():
+        pool = client.Pool(clients=[slow, fast])
+        start = time.perf_counter()
+        response = await pool.query(dns.message.make_query('www.example.com.', 'A'))
+        return response, time.perf_counter() - start
+
+    response, duration = asyncio.run(main())
+    assert response.message.answer[0][0].address == '192.0.2.1'
+    assert duration < 1
+    assert (slow.count, fast.count) == (1, 1)
+
+
+def test_pool_eject_readmit():
+    flaky, backup = Flaky(), Static()
+
+    async def main():
+        pool = client.Pool(clients=[flaky, backup], hedge=False)
+        upstream = pool.upstreams[0]
+        upstream.EJECT_DURATION = 0.2
+
+        for _ in range(client.Upstream.SAMPLES_MIN * 2):
+            await pool.query(dns.message.make_query('www.example.com.', 'A'))
+        is_ejected = not upstream.is_healthy(pool.loop.time())
+        count_ejected = flaky.count
+
+        flaky.is_failing = False
+        await asyncio.sleep(0.3)
+        await pool.query(dns.message.make_query('www.example.com.', 'A'))
+        return is_ejected, count_ejected, upstream.is_healthy(pool.loop.time())
+
+    is_ejected, count_ejected, is_healthy = asyncio.run(main())
+    assert is_ejected
+    assert count_ejected == client.Upstream.SAMPLES_MIN
+    assert flaky.count == count_ejected + 1
+    assert is_healthy
+
+
+def test_http_failover():
+    ips = ['192.0.2.1', '192.0.2.2']
+    failing = {ips[0]}
+
+    def handle(request):
+        if request.url.host in failing:
+            raise httpx.ConnectError('Connection refused', request=request)
+        query = dns.message.from_wire(request.content)
+        return httpx.Response(200, content=get_response(query).to_wire())
+
+    async def main():
+        upstream = client.HTTP(host='doh.test', url='https://{host}/dns-query')
+        upstream.CLIENT = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        upstream.EJECT_DURATION = 0.1
+        upstream.ips, upstream.expires = ips, time.monotonic() + 60
+
+        with mock.patch.object(client.random, 'choice', lambda ips: ips[0]):
+            response = await upstream.query(dns.message.make_query('www.example.com.', 'A'))
+            is_ejected = ips[0] in upstream.ejected
+
+            failing.clear()
+            await asyncio.sleep(0.3)
+            return response, is_ejected, upstream.ejected
+
+    response, is_ejected, ejected = asyncio.run(main())
+    assert response.message.answer[-1][0].address == '192.0.2.1'
+    assert is_ejected
+    assert not ejected
+
+
+def test_server_cache_edns():
+    async def main():
+        async with serve() as proxy:
+            answers, counts = [], []
+            for flags in [(0, True, False), (False, False, False), (0, True, False)]:
+                answers.append(await dns.asyncquery.udp(make_query_flagged(*flags), '127.0.0.1', port=proxy.port, timeout=2))
+                counts.append(proxy.client.count)
+            return answers, counts
+
+    answers, counts = asyncio.run(main())
+    assert [answer.edns >= 0 for answer in answers] == [True, False, True]
+    assert counts[1:] == [counts[0] + 1, counts[0] + 1]  # Only the query without EDNS misses
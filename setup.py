@@ -38,7 +38,7 @@ DEPENDENCIES = {
     'sets': ['pydantic-settings', 'dm', 'yaml'],
     'path.app': ['appdirs'],
     'path.type': ['filetype'],
-    'dns': ['dnspython[doh]', 'http'],
+    'dns': ['dnspython[doh]', 'http', 'caching'],
     'patterns': ['regex'],
     'http': ['httpx', 'httpx_retries', 'logging', 'logfire[httpx]'],
     'setup': ['setuptools'],